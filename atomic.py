@@ -0,0 +1,63 @@
+from os import chmod, close, link, remove, replace, umask
+from os.path import abspath, dirname, exists
+from tempfile import mkstemp
+
+WRITE_BUFFER = 1 << 20
+
+# mkstemp creates files readable by the owner only, outputs get the
+# permissions a plain open() would give them.
+_UMASK = umask(0)
+umask(_UMASK)
+
+
+def _temp_file(_path):
+    return mkstemp(prefix='.', suffix='.tmp', dir=dirname(abspath(_path)))
+
+
+class AtomicFile:
+
+    # A file written under a temporary name next to _path. commit() renames
+    # it onto _path, so readers see either the old file or the whole new
+    # one; discard() drops it.
+
+    def __init__(self, _path, mode='w', buffering=WRITE_BUFFER, **kwargs):
+        self.path = _path
+        fd, self.temp_path = _temp_file(_path)
+        try:
+            self.file = open(fd, mode, buffering=buffering, **kwargs)
+        except BaseException:
+            close(fd)
+            remove(self.temp_path)
+            raise
+
+    def commit(self):
+        self.file.close()
+        chmod(self.temp_path, 0o666 & ~_UMASK)
+        replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        if exists(self.temp_path):
+            remove(self.temp_path)
+
+
+def write_atomically(write, _path, mode='w', **kwargs):
+    target = AtomicFile(_path, mode, **kwargs)
+    try:
+        write(target.file)
+        target.commit()
+    except BaseException:
+        target.discard()
+        raise
+
+def link_atomically(source, _path):
+    fd, temp_path = _temp_file(_path)
+    close(fd)
+    remove(temp_path)
+    try:
+        link(source, temp_path)
+        replace(temp_path, _path)
+    except BaseException:
+        if exists(temp_path):
+            remove(temp_path)
+        raise
@@ -0,0 +1,181 @@
+import json
+from collections import Counter, deque
+from datetime import datetime
+from os import fsync
+from threading import Lock
+from time import monotonic
+
+DONE_STATUSES = ['rebuilt', 'skipped']
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class Journal:
+
+    def __init__(self, _path, resume=False):
+        self._path = _path
+        self._lock = Lock()
+        self._done = set()
+        if resume:
+            for entry in self._read():
+                if entry['status'] in DONE_STATUSES:
+                    self._done.add(entry['directory'])
+                else:
+                    self._done.discard(entry['directory'])
+        else:
+            open(_path, 'w', encoding='utf-8').close()
+
+    def _read(self):
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # The last line is cut short when a run is killed mid-write.
+                continue
+        return entries
+
+    def is_done(self, directory):
+        return directory in self._done
+
+    def record(self, result):
+        directory, status, error = result
+        entry = {
+            'directory': directory, 'status': status,
+            'error': error, 'time': _now()}
+        with self._lock:
+            with open(self._path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                f.flush()
+                fsync(f.fileno())
+            if status in DONE_STATUSES:
+                self._done.add(directory)
+
+
+def _worker_main(connection, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        function, args = task
+        try:
+            connection.send((True, function(*args)))
+        except Exception as e:
+            connection.send((False, f'{type(e).__name__}: {e}'))
+
+
+class _Worker:
+
+    def __init__(self, initializer, initargs):
+        from multiprocessing import Pipe, Process
+
+        self.connection, child_connection = Pipe()
+        self.process = Process(
+            target=_worker_main,
+            args=(child_connection, initializer, initargs), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+
+    # Unlike ProcessPoolExecutor, a worker that hangs past the timeout or
+    # dies is replaced on its own without breaking the rest of the pool.
+
+    def __init__(self, jobs, initializer=None, initargs=(), timeout=None):
+        self.jobs = max(1, jobs)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+
+    def _spawn(self):
+        return _Worker(self.initializer, self.initargs)
+
+    def run(self, function, tasks):
+        from multiprocessing.connection import wait
+
+        pending = deque(tasks)
+        idle = [self._spawn() for i in range(min(self.jobs, len(pending)))]
+        busy = {}
+        try:
+            while pending or busy:
+                while pending and idle:
+                    worker = idle.pop()
+                    key, args = pending.popleft()
+                    worker.connection.send((function, args))
+                    deadline = None
+                    if self.timeout:
+                        deadline = monotonic() + self.timeout
+                    busy[worker.connection] = (worker, key, deadline)
+
+                wait_timeout = None
+                if self.timeout:
+                    wait_timeout = max(
+                        0, min(d for w, k, d in busy.values()) - monotonic())
+                for connection in wait(list(busy), wait_timeout):
+                    worker, key, deadline = busy.pop(connection)
+                    try:
+                        ok, value = connection.recv()
+                    except (EOFError, OSError):
+                        worker.kill()
+                        if pending:
+                            idle.append(self._spawn())
+                        yield key, False, (
+                            f'WorkerCrashed: exit code {worker.process.exitcode}')
+                        continue
+                    idle.append(worker)
+                    yield key, ok, value
+
+                now = monotonic()
+                for connection, (worker, key, deadline) in list(busy.items()):
+                    if deadline is not None and deadline <= now:
+                        del busy[connection]
+                        worker.kill()
+                        if pending:
+                            idle.append(self._spawn())
+                        yield key, False, (
+                            f'Timeout: no result after {self.timeout} s')
+        finally:
+            for worker in idle:
+                worker.stop()
+            for worker, key, deadline in busy.values():
+                worker.kill()
+
+
+def write_run_report(_path, results, **details):
+    report = dict(details)
+    report['finished'] = _now()
+    report['summary'] = dict(Counter(s for d, s, e in results))
+    report['directories'] = [
+        {'directory': d, 'status': s, 'error': e} for d, s, e in results]
+    try:
+        with open(_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    except IOError:
+        print(f'I/O error with <{_path}>.')
@@ -0,0 +1,597 @@
+import argparse
+import json
+import subprocess
+import sys
+import tracemalloc
+from copy import deepcopy
+from io import BytesIO
+from os import chdir, makedirs
+from os.path import abspath, dirname, exists, join
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import openpyxl
+from docx import Document
+
+from coordinates import catalogs_equal, to_coordinates
+from directive import Directive
+from ex_to_word import (
+    APPENDIX_TEMPLATE, DIRECTIVE_TEMPLATE, convert_data_to_str,
+    create_appendix_content, create_directive_text, create_document_framework,
+    extract_columns, iter_xlsx_coordinates, process_directory,
+    read_textfile, read_xlsx_coordinates, template_variants)
+
+
+CATALOG_FILENAMES = [
+    'каталог координат БЛ.xlsx',
+    'каталог координат ВОЗ.xlsx',
+    'каталог координат ПЗП.xlsx',
+]
+FILENAMES = sorted(CATALOG_FILENAMES + ['content.txt'])
+
+
+def create_catalog(_path, points, seed=0):
+    rnd = Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(['Каталог координат'])
+    sheet.append(['Приложение'])
+    sheet.append([None, 'Система координат МСК-50 (зона 2)'])
+    sheet.append(['Номер точки', 'X', 'Y'])
+    sheet.append(['1', '2', '3'])
+    for i in range(1, points + 1):
+        sheet.append([
+            i,
+            450000 + rnd.random() * 1000,
+            2200000 + rnd.random() * 1000
+        ])
+    wb.save(_path)
+    return _path
+
+
+def create_waterbody(directory, points, equal_appendices=True, seed=0):
+    makedirs(directory, exist_ok=True)
+    for i, name in enumerate(CATALOG_FILENAMES):
+        if equal_appendices and i == 2:
+            i = 1
+        create_catalog(join(directory, name), points, seed * 3 + i)
+    with open(join(directory, 'content.txt'), 'w', encoding='utf-8') as f:
+        f.write(f'реки Тестовой-{seed}\n{seed}\n1,5\n100\n50\n')
+    return directory
+
+
+def create_fixture_tree(root, directories, points, equal_appendices=True):
+    return [
+        create_waterbody(
+            join(root, f'{i:03d} река Тестовая'), points,
+            equal_appendices, seed=i)
+        for i in range(directories)
+    ]
+
+
+def legacy_read_xlsx(_path):
+    wb = openpyxl.load_workbook(_path)
+    sheet = wb.active
+    data = [[cell.value for cell in row] for row in sheet.rows]
+    data = [row for row in data if row != [None for el in row]]
+    return data[2][1], [row[:3] for row in data[5:]]
+
+
+def streaming_read_xlsx(_path):
+    rows = iter_xlsx_coordinates(_path)
+    title = next(rows, None)
+    return title, list(rows)
+
+
+LOADERS = {
+    'legacy': legacy_read_xlsx,
+    'streaming': streaming_read_xlsx,
+}
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def measure_loader(name, _path):
+    loader = LOADERS[name]
+    rss_before = peak_rss_kb()
+    tracemalloc.start()
+    time_start = perf_counter()
+    title, rows = loader(_path)
+    elapsed = perf_counter() - time_start
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'loader': name,
+        'rows': len(rows),
+        'time_ms': elapsed * 1e3,
+        'traced_peak_kb': traced_peak // 1024,
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_isolated(name, _path):
+    # Peak RSS is per process, so every loader runs in a fresh interpreter.
+    output = subprocess.run(
+        [sys.executable, abspath(__file__), 'xlsx', '--measure', name, _path],
+        cwd=dirname(abspath(__file__)),
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def compare_loaders(_path):
+    results = [run_isolated(name, _path) for name in LOADERS]
+    for r in results:
+        rss = r['peak_rss_kb']
+        rss = f'{rss} KB' if rss is not None else 'n/a'
+        print(
+            f"{r['loader']:>10}: {r['rows']} rows, {r['time_ms']:.1f} ms, "
+            f"traced peak {r['traced_peak_kb']} KB, peak RSS {rss}")
+    return results
+
+
+class LegacyDirective(Directive):
+
+    def _create_mask(self, text_list, substitution):
+        flags = []
+        text = []
+        for el in text_list:
+            subs = substitution.get(el, None)
+            if subs == None:
+                flags.append(0)
+            elif subs == el:
+                flags.append(2)
+            else:
+                flags.append(1)
+                el = subs
+            text.append(el)
+        return {
+            'flags': flags,
+            'text': text
+        }
+
+    def _create_template_mask(self, template, _substitution, _sep):
+        split_substitution = {
+            k: f'{_sep}{{{k}}}{_sep}' for k in _substitution.keys()}
+        text = []
+        flags = []
+        substitution = {
+            f'{{{k}}}': v.replace('{NBS}', chr(160)) for
+            k, v in _substitution.items()}
+        for line in template:
+            line = line.replace('{NBS}', chr(160))
+            text_list = [
+                el for el in line.format(
+                    **split_substitution).split(_sep) if el]
+            mask = self._create_mask(text_list, substitution)
+            text.append(mask['text'])
+            flags.append(mask['flags'])
+
+        return {
+            'text': text,
+            'flags': flags
+        }
+
+    def _fill_table(self, table, data):
+        tbl = table._tbl
+        template = tbl.tr_lst[-1]
+        tbl.remove(template)
+        for row in data:
+            tbl.append(deepcopy(template))
+        w = len(data[0])
+        for i, c in enumerate(table._cells[9:]):
+            c.text = data[i//w][i%w]
+
+
+def create_str_coordinates(points, seed=0):
+    rnd = Random(seed)
+    return [
+        [
+            str(i),
+            f'{450000 + rnd.random() * 1000:.2f}'.replace('.', ','),
+            f'{2200000 + rnd.random() * 1000:.2f}'.replace('.', ',')
+        ] for i in range(1, points + 1)
+    ]
+
+
+def compare_table_builders(row_counts):
+    results = []
+    for points in row_counts:
+        data = create_str_coordinates(points)
+        timings = {}
+        for name, directive in [
+                ('legacy', LegacyDirective()), ('bulk', Directive())]:
+            document = Document()
+            time_start = perf_counter()
+            directive._add_table(document, data, 'МСК-50 (зона 2)')
+            timings[name] = (perf_counter() - time_start) * 1e3
+        speedup = timings['legacy'] / timings['bulk']
+        print(
+            f'{points:>8} rows: legacy {timings["legacy"]:.1f} ms, '
+            f'bulk {timings["bulk"]:.1f} ms, x{speedup:.1f}')
+        results.append({'rows': points, **timings})
+    return results
+
+
+def measure_docx_assembly(mode, points):
+    data = create_str_coordinates(points)
+    _path = join(mkdtemp(), 'Directive.docx')
+    rss_before = peak_rss_kb()
+    time_start = perf_counter()
+    directive = Directive(stream_rows=0 if mode == 'stream' else None)
+    document = directive._new_document()
+    for i in range(3):
+        directive._add_table(document, data, 'МСК-50 (зона 2)')
+    directive._save(document, _path)
+    elapsed = perf_counter() - time_start
+    return {
+        'mode': mode,
+        'rows': points,
+        'time_ms': elapsed * 1e3,
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def compare_docx_assembly(row_counts):
+    # Every measurement runs in a fresh interpreter, see run_isolated.
+    results = []
+    for points in row_counts:
+        for mode in ['tree', 'stream']:
+            output = subprocess.run(
+                [sys.executable, abspath(__file__), 'docx',
+                    '--measure', mode, '--rows', str(points)],
+                cwd=dirname(abspath(__file__)),
+                capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.splitlines()[-1])
+            rss = r['peak_rss_kb']
+            growth = f"{rss - r['rss_before_kb']} KB" if rss is not None else 'n/a'
+            print(
+                f"{points:>8} rows x 3, {mode:>6}: {r['time_ms']:.1f} ms, "
+                f"peak RSS growth {growth}")
+            results.append(r)
+    return results
+
+
+def create_raw_coordinates(points, seed=0):
+    rnd = Random(seed)
+    return [
+        (i, 450000 + rnd.random() * 1000, 2200000 + rnd.random() * 1000)
+        for i in range(1, points + 1)
+    ]
+
+
+def compare_formatters(points):
+    rows = create_raw_coordinates(points)
+    other = list(rows)
+
+    time_start = perf_counter()
+    legacy = convert_data_to_str(rows, ['{:.0f}', '{:.2f}', '{:.2f}'])
+    extract_columns(legacy, [1, 2])
+    legacy_equal = rows == other
+    legacy_time = (perf_counter() - time_start) * 1e3
+
+    time_start = perf_counter()
+    coordinates = to_coordinates(rows)
+    other_coordinates = to_coordinates(other)
+    convert_time = (perf_counter() - time_start) * 1e3
+    time_start = perf_counter()
+    formatted = coordinates.format()
+    formatted[:, 1:]
+    array_equal = catalogs_equal(coordinates, other_coordinates)
+    array_time = (perf_counter() - time_start) * 1e3
+
+    assert formatted.tolist() == legacy and legacy_equal == array_equal
+    print(
+        f'{points} points: legacy {legacy_time:.1f} ms, '
+        f'numpy {array_time:.1f} ms (+{convert_time:.1f} ms to build arrays)')
+    return {
+        'points': points, 'legacy': legacy_time,
+        'numpy': array_time, 'convert': convert_time}
+
+
+def legacy_new_document(directive):
+    unused = Document()
+    directive._set_page_properties(unused)
+    directive._set_directive_styles(unused)
+    return directive._create_base_document()
+
+
+def compare_document_startup(repeat):
+    directive = Directive()
+    directive._new_document()
+    timings = {}
+    for name, create in [
+            ('legacy', legacy_new_document),
+            ('prepared', Directive._new_document)]:
+        time_start = perf_counter()
+        for i in range(repeat):
+            create(directive)
+        timings[name] = (perf_counter() - time_start) * 1e3 / repeat
+    print(
+        f'Per-directive startup: legacy {timings["legacy"]:.2f} ms, '
+        f'prepared {timings["prepared"]:.2f} ms')
+    return timings
+
+
+HEAVY_MODULES = ['numpy', 'openpyxl', 'docx', 'lxml']
+
+
+def measure_imports(args):
+    # -X importtime reports every import on stderr as
+    # "import time: self [us] | cumulative | name", nested names indented.
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        cwd=dirname(abspath(__file__)),
+        capture_output=True, text=True
+    ).stderr
+    total = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line.split('|')
+        if not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        modules.add(name.strip())
+        if not name.startswith('  '):
+            total += int(fields[1])
+    return {
+        'time_ms': total / 1e3,
+        'heavy': [m for m in HEAVY_MODULES if m in modules],
+    }
+
+
+def compare_startup_imports(target, repeat):
+    results = {}
+    for name, args in [
+            ('import', ['-c', 'import ex_to_word']),
+            ('scan-only', ['ex_to_word.py', '--scan-only', target]),
+            ('all stages', [
+                '-c', 'import ex_to_word, coordinates, directive, openpyxl'])]:
+        runs = [measure_imports(args) for i in range(repeat)]
+        result = min(runs, key=lambda r: r['time_ms'])
+        heavy = ', '.join(result['heavy']) or 'none'
+        print(
+            f'{name:>10}: imports {result["time_ms"]:.1f} ms, '
+            f'heavy modules: {heavy}')
+        results[name] = result
+    return results
+
+
+def compare_template_rendering(waterbodies):
+    directive_template = read_textfile(_path=DIRECTIVE_TEMPLATE)
+    appendix_framework = create_document_framework(
+        read_textfile(_path=APPENDIX_TEMPLATE),
+        [0, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14],
+        ['\n', '', '', '', '', '', '', '', '', '']
+    )
+    substitutions = [
+        {
+            'WBN': f'реки Тестовой-{i}', 'DN': str(i), 'WBL': '1,5',
+            'WPZ': '100', 'PSB': '{PSB}' if i % 10 else '50'
+        } for i in range(waterbodies)
+    ]
+
+    timings = {}
+    results = {}
+    directive = LegacyDirective()
+    masks = []
+    time_start = perf_counter()
+    for i, substitution in enumerate(substitutions):
+        text = create_directive_text(directive_template, i % 2 == 0)
+        masks.append(directive._create_template_mask(text, substitution, '#'))
+        for n in ['1', '2', '3']:
+            content = create_appendix_content(appendix_framework, n)
+            masks.append(directive._create_template_mask(
+                content, substitution, '#'))
+    timings['legacy'] = (perf_counter() - time_start) * 1e3
+    results['legacy'] = masks
+
+    directive = Directive()
+    masks = []
+    time_start = perf_counter()
+    for i, substitution in enumerate(substitutions):
+        # The digest stands in for the template files, which do not change.
+        variants = template_variants(
+            directive_template, appendix_framework, 'benchmark')
+        masks.append(directive._fill_template(
+            variants['directive'][i % 2 == 0], substitution))
+        for n in ['1', '2', '3']:
+            masks.append(directive._fill_template(
+                variants['appendix'][n], substitution))
+    timings['registry'] = (perf_counter() - time_start) * 1e3
+    results['registry'] = [
+        {'text': m['text'], 'flags': m['flags']} for m in masks]
+
+    assert results['legacy'] == results['registry']
+    print(
+        f'{waterbodies} waterbodies: legacy {timings["legacy"]:.1f} ms, '
+        f'registry {timings["registry"]:.1f} ms')
+    return timings
+
+
+def best_of(repeat, function, *args, **kwargs):
+    best = None
+    for i in range(repeat):
+        time_start = perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = (perf_counter() - time_start) * 1e3
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_suite(root, directories, points, equal_appendices=True, repeat=3):
+    # process_directory reads the templates relative to the working directory.
+    chdir(dirname(abspath(__file__)))
+    waterbodies = create_fixture_tree(
+        root, directories, points, equal_appendices)
+    catalog = join(waterbodies[0], CATALOG_FILENAMES[0])
+
+    timings = {}
+    timings['read_xlsx'], (title, rows) = best_of(
+        repeat, read_xlsx_coordinates, _path=catalog)
+    timings['convert_data_to_str'], _ = best_of(
+        repeat, convert_data_to_str, rows, ['{:.0f}', '{:.2f}', '{:.2f}'])
+    timings['format_coordinates'], formatted = best_of(
+        repeat, lambda: to_coordinates(rows).format())
+    data = formatted.tolist()
+
+    directive = Directive()
+    directive._new_document()
+    timings['add_table'], document = best_of(
+        repeat, lambda: directive._add_table(Document(), data, title))
+    # The save path production uses, at the default level and stored.
+    timings['save_docx'], _ = best_of(
+        repeat, lambda: directive._save(document, BytesIO()))
+    timings['save_docx_stored'], _ = best_of(
+        repeat, lambda: directive._save(document, BytesIO(), compress_level=0))
+    timings['process_directory'], _ = best_of(
+        1, process_directory, FILENAMES, _path=root, force=True)
+
+    return {
+        'params': {
+            'directories': directories,
+            'points': points,
+            'equal_appendices': equal_appendices,
+        },
+        'timings': timings,
+    }
+
+
+def compare_with_baseline(result, baseline, threshold):
+    regressions = []
+    for stage, value in result['timings'].items():
+        base = baseline['timings'].get(stage)
+        if base is None:
+            print(f'{stage:>20}: {value:.1f} ms (no baseline)')
+            continue
+        ratio = value / base if base else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(stage)
+        print(f'{stage:>20}: {value:.1f} ms vs {base:.1f} ms, x{ratio:.2f}{flag}')
+    if result['params'] != baseline['params']:
+        print(f"Baseline parameters differ: {baseline['params']}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for ex_to_word.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    xlsx_parser = subparsers.add_parser(
+        'xlsx', help='compare the legacy and streaming xlsx loaders')
+    xlsx_parser.add_argument('xlsx', nargs='?', help='catalog to read')
+    xlsx_parser.add_argument('--points', type=int, default=20000)
+    xlsx_parser.add_argument('--measure', choices=list(LOADERS))
+
+    table_parser = subparsers.add_parser(
+        'table', help='compare per-cell and bulk coordinate tables')
+    table_parser.add_argument(
+        '--rows', type=int, nargs='+', default=[1000, 5000, 20000])
+
+    docx_parser = subparsers.add_parser(
+        'docx', help='compare in-memory and streamed appendix tables')
+    docx_parser.add_argument(
+        '--rows', type=int, nargs='+', default=[5000, 20000, 50000])
+    docx_parser.add_argument('--measure', choices=['tree', 'stream'])
+
+    format_parser = subparsers.add_parser(
+        'format', help='compare list and NumPy coordinate formatting')
+    format_parser.add_argument('--points', type=int, default=100000)
+
+    startup_parser = subparsers.add_parser(
+        'startup', help='compare per-directive document startup cost')
+    startup_parser.add_argument('--repeat', type=int, default=100)
+
+    imports_parser = subparsers.add_parser(
+        'imports', help='measure import time of the command line with '
+        '-X importtime')
+    imports_parser.add_argument(
+        'target', nargs='?', help='directory for --scan-only')
+    imports_parser.add_argument('--repeat', type=int, default=5)
+
+    template_parser = subparsers.add_parser(
+        'template',
+        help='compare per-call template masking with compiled variants')
+    template_parser.add_argument('--waterbodies', type=int, default=1000)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='time every stage on generated waterbody directories')
+    suite_parser.add_argument('--directories', type=int, default=5)
+    suite_parser.add_argument('--points', type=int, default=2000)
+    suite_parser.add_argument(
+        '--unequal', action='store_true',
+        help='generate different catalogs for appendices 2 and 3')
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument(
+        '--fixtures', help='directory for the generated waterbodies')
+    suite_parser.add_argument('--save-baseline', metavar='FILE')
+    suite_parser.add_argument('--compare', metavar='FILE')
+    suite_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'table':
+        compare_table_builders(args.rows)
+    elif args.command == 'docx':
+        if args.measure:
+            print(json.dumps(
+                measure_docx_assembly(args.measure, args.rows[0])))
+        else:
+            compare_docx_assembly(args.rows)
+    elif args.command == 'format':
+        compare_formatters(args.points)
+    elif args.command == 'startup':
+        compare_document_startup(args.repeat)
+    elif args.command == 'imports':
+        target = args.target
+        if target is None:
+            target = mkdtemp()
+            create_fixture_tree(target, 2, 100)
+        compare_startup_imports(abspath(target), args.repeat)
+    elif args.command == 'template':
+        compare_template_rendering(args.waterbodies)
+    elif args.command == 'suite':
+        result = run_suite(
+            abspath(args.fixtures or mkdtemp()), args.directories,
+            args.points, not args.unequal, args.repeat)
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                regressions = compare_with_baseline(
+                    result, json.load(f), args.threshold)
+        else:
+            for stage, value in result['timings'].items():
+                print(f'{stage:>20}: {value:.1f} ms')
+        if args.save_baseline:
+            with open(args.save_baseline, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        if args.compare and regressions:
+            sys.exit(1)
+    elif args.measure:
+        print(json.dumps(measure_loader(args.measure, args.xlsx)))
+    else:
+        xlsx = args.xlsx
+        if xlsx is None or not exists(xlsx):
+            xlsx = create_catalog(
+                join(mkdtemp(), 'каталог координат БЛ.xlsx'), args.points)
+        compare_loaders(xlsx)
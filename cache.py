@@ -0,0 +1,180 @@
+import json
+import struct
+from argparse import ArgumentParser
+from hashlib import sha256
+from os import listdir, makedirs, remove, stat, utime
+from os.path import join
+from threading import Lock
+
+from atomic import write_atomically
+
+MAGIC = b'EXWCOL1\0'
+CACHE_EXTENSION = '.col'
+DEFAULT_CACHE_SIZE = 512 << 20
+_ALIGN = 8
+
+
+def file_key(_path, digest=None):
+    # digest is the SHA-256 of the file's content if the caller has it.
+    h = sha256(str(stat(_path).st_mtime_ns).encode())
+    if digest is not None:
+        h.update(digest.encode())
+        return h.hexdigest()
+    file_hash = sha256()
+    with open(_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    h.update(file_hash.hexdigest().encode())
+    return h.hexdigest()
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def write_columns(f, title, coordinates):
+    import numpy as np
+
+    # Layout: magic, header length, JSON header, then every column as raw
+    # little-endian data starting at an 8-byte aligned offset.
+    columns = [np.ascontiguousarray(c, c.dtype.newbyteorder('<'))
+        for c in coordinates.columns()]
+    offsets = []
+    offset = 0
+    for c in columns:
+        offsets.append(offset)
+        offset = _aligned(offset + c.nbytes)
+    header = json.dumps({
+        'title': title,
+        'rows': len(coordinates),
+        'columns': [
+            {'dtype': c.dtype.str, 'offset': o}
+            for c, o in zip(columns, offsets)]
+    }, ensure_ascii=False).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for c, o in zip(columns, offsets):
+        f.seek(data_start + o)
+        f.write(c.tobytes())
+
+def read_columns(_path):
+    import numpy as np
+    from coordinates import Coordinates
+
+    with open(_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'<{_path}> is not a coordinate cache file.')
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+    columns = [
+        np.memmap(
+            _path, dtype=np.dtype(c['dtype']), mode='r',
+            offset=data_start + c['offset'], shape=(header['rows'],))
+        if header['rows'] else np.empty(0, dtype=np.dtype(c['dtype']))
+        for c in header['columns']
+    ]
+    return header['title'], Coordinates(*columns)
+
+
+class CoordinateCache:
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        makedirs(directory, exist_ok=True)
+        self._size = sum(size for name, size, mtime in self._entries())
+
+    def _entries(self):
+        result = []
+        for name in listdir(self.directory):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            try:
+                s = stat(join(self.directory, name))
+            except OSError:
+                continue
+            result.append((name, s.st_size, s.st_mtime))
+        return result
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def load(self, xlsx_path, digest=None):
+        key = file_key(xlsx_path, digest)
+        cache_path = join(self.directory, f'{key}{CACHE_EXTENSION}')
+        try:
+            result = read_columns(cache_path)
+            # The modification time marks the entry as recently used.
+            utime(cache_path)
+        except (OSError, ValueError):
+            self._count(False)
+            return key, None
+        self._count(True)
+        return key, result
+
+    def store(self, key, title, coordinates):
+        if any(c.dtype == object for c in coordinates.columns()):
+            return
+        cache_path = join(self.directory, f'{key}{CACHE_EXTENSION}')
+        try:
+            write_atomically(
+                lambda f: write_columns(f, title, coordinates), cache_path,
+                'wb')
+        except OSError:
+            return
+        with self._lock:
+            self._size += stat(cache_path).st_size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.prune()
+
+    def prune(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for name, entry_size, mtime in entries:
+            if size <= max_bytes:
+                break
+            try:
+                remove(join(self.directory, name))
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        with self._lock:
+            self._size = size
+        return removed, size
+
+    def drain_stats(self):
+        with self._lock:
+            stats = (self.hits, self.misses)
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Manage the coordinate catalog cache.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    prune_parser = subparsers.add_parser(
+        'prune', help='evict least recently used entries')
+    prune_parser.add_argument('cache_dir')
+    prune_parser.add_argument(
+        '--max-size', type=float, default=DEFAULT_CACHE_SIZE / (1 << 20),
+        help='size to shrink the cache to, in megabytes')
+    args = parser.parse_args()
+
+    cache = CoordinateCache(args.cache_dir)
+    removed, size = cache.prune(int(args.max_size * (1 << 20)))
+    print(f'Removed {removed} entries, {size / (1 << 20):.1f} MB left.')
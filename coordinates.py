@@ -0,0 +1,141 @@
+from hashlib import sha256
+from itertools import chain
+
+import numpy as np
+
+# Values closer than this to a rounding tie, or too large for the scaled
+# value to be exact, are formatted one by one to match str.format exactly.
+_TIE_MARGIN = 1e-3
+_EXACT_LIMIT = 1e12
+
+# Layout of the binary export: little-endian point ID, X and Y.
+RECORD_DTYPE = np.dtype([('id', '<i8'), ('x', '<f8'), ('y', '<f8')])
+
+
+class Coordinates:
+
+    def __init__(self, ids, x, y):
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def columns(self):
+        return [self.ids, self.x, self.y]
+
+    def format(self, decimals=(0, 2, 2), separator=','):
+        if not len(self):
+            return np.empty((0, 3), dtype=str)
+        return np.stack([
+            format_column(c, d, separator)
+            for c, d in zip(self.columns(), decimals)], axis=1)
+
+    def fingerprint(self):
+        # Identical values give identical digests, whether the columns were
+        # parsed from xlsx or mapped from the cache.
+        if self._fingerprint is None:
+            h = sha256()
+            for c in self.columns():
+                h.update(c.dtype.str.encode())
+                if c.dtype == object:
+                    h.update(repr(c.tolist()).encode('utf-8'))
+                else:
+                    h.update(np.ascontiguousarray(c).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def to_records(self):
+        if any(c.dtype == object for c in self.columns()):
+            return None
+        records = np.empty(len(self), dtype=RECORD_DTYPE)
+        records['id'] = self.ids
+        records['x'] = self.x
+        records['y'] = self.y
+        return records
+
+    def equals(self, other, tolerance=0.0):
+        if len(self) != len(other):
+            return False
+        if self is other or self.fingerprint() == other.fingerprint():
+            return True
+        for i, (a, b) in enumerate(zip(self.columns(), other.columns())):
+            if a.dtype == object or b.dtype == object:
+                if not all(a_el == b_el for a_el, b_el in zip(a, b)):
+                    return False
+            elif i and tolerance:
+                if not np.allclose(a, b, rtol=0, atol=tolerance):
+                    return False
+            elif not np.array_equal(a, b):
+                return False
+        return True
+
+
+def _is_numeric(values):
+    return set(map(type, values)) <= {int, float}
+
+def _to_integral(column):
+    if np.all(np.isfinite(column)) and np.all(column % 1 == 0):
+        return column.astype(np.int64)
+    return column
+
+def to_column(values, integral=False):
+    if not _is_numeric(values):
+        return np.array(values, dtype=object)
+    column = np.array(values, dtype=np.float64)
+    return _to_integral(column) if integral else column
+
+def to_coordinates(rows):
+    if not rows:
+        rows = np.empty((0, 3))
+    elif _is_numeric(chain.from_iterable(rows)):
+        rows = np.array(rows, dtype=np.float64)
+    else:
+        ids, x, y = zip(*rows)
+        return Coordinates(
+            to_column(ids, integral=True), to_column(x), to_column(y))
+    return Coordinates(
+        _to_integral(rows[:, 0].copy()), rows[:, 1].copy(), rows[:, 2].copy())
+
+def _format_value(value, decimals, separator=','):
+    if type(value) == str:
+        return value
+    return f'{value:.{decimals}f}'.replace('.', separator)
+
+def format_column(column, decimals, separator=','):
+    if column.dtype == object:
+        return np.array(
+            [_format_value(v, decimals, separator) for v in column], dtype=str)
+    if column.dtype.kind in 'iu':
+        return column.astype(str)
+
+    scale = 10 ** decimals
+    # Infinite and NaN cells end up inexact and are formatted one by one.
+    with np.errstate(invalid='ignore'):
+        scaled = column * scale
+        rounded = np.rint(scaled)
+        magnitude = np.abs(rounded)
+        fraction = np.abs(scaled - np.trunc(scaled))
+        inexact = ~(
+            np.isfinite(scaled) & (magnitude < _EXACT_LIMIT) &
+            (np.abs(fraction - 0.5) > _TIE_MARGIN))
+
+    magnitude = np.where(inexact, 0, magnitude).astype(np.int64)
+    result = np.char.add(
+        np.where(np.signbit(column), '-', ''),
+        (magnitude // scale).astype(str))
+    if decimals:
+        fractions = np.array(
+            [f'{separator}{i:0{decimals}d}' for i in range(scale)])
+        result = np.char.add(result, fractions[magnitude % scale])
+    if inexact.any():
+        result = result.astype(object)
+        for i in np.flatnonzero(inexact):
+            result[i] = _format_value(float(column[i]), decimals, separator)
+        result = result.astype(str)
+    return result
+
+def catalogs_equal(a, b, tolerance=0.0):
+    return a.equals(b, tolerance)
@@ -1,15 +1,49 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import remove
+from os.path import exists
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from lxml import etree
+
 from docx import Document
-from docx.oxml import OxmlElement, ns
+from docx.oxml import OxmlElement, ns, parse_xml
 from docx.oxml.ns import qn
 from docx.shared import Cm, Pt
 from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.section import WD_SECTION
-from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_COLOR_INDEX, WD_BREAK
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_BREAK
 from docx.enum.table import WD_ALIGN_VERTICAL
+from docx.opc.pkgwriter import _ContentTypesItem
+
+from atomic import AtomicFile
+from instrumentation import span, timeit
+from render import write_output
+from styles import table_head
+from zipwriter import (
+    CHUNK_SIZE, DEFAULT_COMPRESS_LEVEL, SAVE_THREADS, ZipWriter)
+
+_ROWS_MARKER = 'deferred rows '
+_DOCUMENT_PART = 'word/document.xml'
+HIGHLIGHT_COLORS = {1: 'yellow', 2: 'red'}
+APPENDIX_STYLES = [
+    'Appendix Title', 'Appendix Document Number',
+    'Appendix Document Title', 'Appendix Text'
+]
 
 class Directive:
 
-    
+    # Serialized document with page properties, styles and header already
+    # set up. It is built once per process and loaded for every directive.
+    _base_document = None
+
+    def __init__(self, stream_rows=None):
+        # Tables with at least stream_rows rows are not built in the tree
+        # but streamed into the saved file, see _defer_table.
+        self.stream_rows = stream_rows
+        self._deferred_tables = []
 
     def _create_element(self, name):
         return OxmlElement(name)
@@ -130,123 +164,186 @@ class Directive:
             c.vertical_alignment = WD_ALIGN_VERTICAL.BOTTOM
             c.paragraphs[0].style = s
 
-    def _create_mask(self, text_list, substitution):
-        flags = []
-        text = []
-        for el in text_list:
-            subs = substitution.get(el, None)
-            if subs == None:
-                flags.append(0)
-            elif subs == el:
-                flags.append(2)
-            else:
-                flags.append(1)
-                el = subs
-            text.append(el)
-        return {
-            'flags': flags,
-            'text': text
-        }
-
-    def _apply_mask(self, paragraph, text_list, flags):
-        for t, f in zip(text_list, flags):
-            r = paragraph.add_run(t)
-            if f == 1:
-                r.font.highlight_color = WD_COLOR_INDEX.YELLOW
-            elif f == 2:
-                r.font.highlight_color = WD_COLOR_INDEX.RED
-
-    def __init__(self):
-        self._document = Document()
-        self._set_page_properties(self._document)
-        self._set_directive_styles(self._document)
-
-    def _add_appendix(self, document, content, substitution):
-        appendix_styles = [
-            document.styles['Appendix Title'],
-            document.styles['Appendix Document Number'],
-            document.styles['Appendix Document Title'],
-            document.styles['Appendix Text']
-        ]
-        document.add_section()
-
-        content_mask = self._create_template_mask(
-            content, substitution, '#')
-        text = content_mask['text']
-        flags = content_mask['flags']
-
-        for line, flag_line, s in zip(text, flags, appendix_styles):
-            p = document.add_paragraph(style=s)
-            self._apply_mask(p, line, flag_line)
-
+    def _set_header(self, document):
+        paragraph = document.sections[0].header.paragraphs[0]
+        paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        paragraph.style.font.size = Pt(12)
+        paragraph.style.font.name = 'Times New Roman'
+        self._add_page_number(paragraph.add_run())
 
+    def _create_base_document(self):
+        document = Document()
+        self._set_page_properties(document)
+        self._set_directive_styles(document)
+        self._set_header(document)
+        self._set_appendix_styles(document)
         return document
 
-    def _create_template_mask(self, template, _substitution, _sep):
-        split_substitution = {
-            k: f'{_sep}{{{k}}}{_sep}' for k in _substitution.keys()}
-        text = []
-        flags = []
-        substitution = {
-            f'{{{k}}}': v.replace('{NBS}', chr(160)) for 
-            k, v in _substitution.items()}
-        for line in template:
-            line = line.replace('{NBS}', chr(160))
-            text_list = [
-                el for el in line.format(
-                    **split_substitution).split(_sep) if el]
-            mask = self._create_mask(text_list, substitution)
-            text.append(mask['text'])
-            flags.append(mask['flags'])
+    @timeit('new_document')
+    def _new_document(self):
+        if Directive._base_document is None:
+            stream = BytesIO()
+            self._create_base_document().save(stream)
+            Directive._base_document = stream.getvalue()
+        return Document(BytesIO(Directive._base_document))
 
+    def _paragraph_block(self, style, text_list, flags=(), run_xml=()):
+        # run_xml holds the docx XML of literal runs, None for the others.
         return {
-            'text': text,
-            'flags': flags
+            'type': 'paragraph',
+            'style': style,
+            'runs': list(zip(text_list, flags)),
+            'run_xml': list(run_xml)
         }
 
-    def _create_directive(self, directive_template, substitution):
-        directive_mask = self._create_template_mask(
-            directive_template, substitution, '#')
-
+    def _directive_blocks(self, compiled, substitution):
+        directive_mask = self._fill_template(compiled, substitution)
         text = directive_mask['text']
         flags = directive_mask['flags']
+        run_xml = directive_mask['xml']
 
-
-        document = Document()
-        self._set_page_properties(document)
-        
-        [
-            title_style, main_style,
-            position_style, name_style
-        ] = self._set_directive_styles(document)
-
+        blocks = []
         if text:
-            for line, flag_line in zip(text[:-4], flags[:-4]):
-                p = document.add_paragraph(style=main_style)
-                self._apply_mask(p, line, flag_line)
-
-        document.paragraphs[0].style = title_style
-        
+            for line, flag_line, xml_line in zip(
+                    text[:-4], flags[:-4], run_xml[:-4]):
+                blocks.append(self._paragraph_block(
+                    'Directive Text', line, flag_line, xml_line))
         for i in range(3):
-            document.add_paragraph(style=main_style)
-            
+            blocks.append(self._paragraph_block('Directive Text', []))
+        blocks[0]['style'] = 'Directive Title'
+
         position = '\n'.join([el[0] for el in text[-4:-1]])
         name = text[-1][0]
+        blocks.append({
+            'type': 'signature',
+            'cells': [position, name],
+            'styles': ['Directive Position', 'Directive Name']
+        })
+        blocks.append({'type': 'page_break'})
+        return blocks
+
+    def _appendix_blocks(self, compiled, substitution, data, coordinates_title):
+        content_mask = self._fill_template(compiled, substitution)
+        blocks = [{'type': 'section'}]
+        for line, flag_line, xml_line, s in zip(
+                content_mask['text'], content_mask['flags'],
+                content_mask['xml'], APPENDIX_STYLES):
+            blocks.append(self._paragraph_block(s, line, flag_line, xml_line))
+        blocks.append({
+            'type': 'table',
+            'title': coordinates_title,
+            'rows': data
+        })
+        return blocks
+
+    def _create_model(self, directive_compiled, substitution, appendices):
+        # The model is plain data shared by every output backend, none of
+        # them may change it. Templates come compiled, see
+        # _compile_template, and appendices holds (compiled, rows, title).
+        blocks = self._directive_blocks(directive_compiled, substitution)
+        for compiled, data, coordinates_title in appendices:
+            blocks += self._appendix_blocks(
+                compiled, substitution, data, coordinates_title)
+        return {'blocks': blocks}
+
+    @timeit('render_docx')
+    def _render(self, model):
+        document = self._new_document()
+        styles = document.styles
+        style_ids = {}
+        paragraphs = []
+        for block in model['blocks']:
+            kind = block['type']
+            if kind == 'paragraph':
+                style = block['style']
+                if style not in style_ids:
+                    style_ids[style] = styles[style].style_id
+                paragraphs.append(self._paragraph_xml(style_ids[style], block))
+                continue
+            # Consecutive paragraphs are parsed in one go.
+            self._add_paragraphs(document, paragraphs)
+            paragraphs = []
+            if kind == 'signature':
+                self._create_position_table(
+                    document, block['cells'],
+                    [styles[s] for s in block['styles']])
+            elif kind == 'page_break':
+                document.add_page_break()
+            elif kind == 'section':
+                document.add_section()
+            elif kind == 'table':
+                self._add_table(document, block['rows'], block['title'])
+        self._add_paragraphs(document, paragraphs)
+        self._create_right_numeration(document)
+        return document
 
-        self._create_position_table(
-            document, [position, name],
-            [position_style, name_style])
-        document.add_page_break()
+    def _paragraph_xml(self, style_id, block):
+        xml = [f'<w:p><w:pPr><w:pStyle w:val="{escape(style_id)}"/></w:pPr>']
+        run_xml = block.get('run_xml') or [None] * len(block['runs'])
+        for (text, flag), run in zip(block['runs'], run_xml):
+            xml.append(run if run is not None else self._run_xml(text, flag))
+        xml.append('</w:p>')
+        return ''.join(xml)
+
+    def _add_paragraphs(self, document, paragraphs):
+        if not paragraphs:
+            return
+        body = document.element.body
+        chunk = parse_xml(
+            f'<w:body {ns.nsdecls("w")}>{"".join(paragraphs)}</w:body>')
+        for p in list(chunk):
+            body._insert_p(p)
+
+    def _compile_template(self, template, keys, _sep):
+        # Lines split into (substitution key, text, run XML) fragments. The
+        # key is None for literal text, whose run XML is built here once.
+        split_substitution = {k: f'{_sep}{{{k}}}{_sep}' for k in keys}
+        slots = {f'{{{k}}}': k for k in keys}
+        compiled = []
+        for line in template:
+            line = line.replace('{NBS}', chr(160))
+            compiled.append([
+                (slots.get(el), el,
+                    None if el in slots else self._run_xml(el))
+                for el in line.format(**split_substitution).split(_sep) if el])
+        return compiled
+
+    @timeit('build_mask')
+    def _fill_template(self, compiled, _substitution):
+        text = []
+        flags = []
+        run_xml = []
+        substitution = {
+            k: v.replace('{NBS}', chr(160)) for k, v in _substitution.items()}
+        for line in compiled:
+            line_text = []
+            line_flags = []
+            line_xml = []
+            for key, el, xml in line:
+                if key is None:
+                    line_flags.append(0)
+                elif substitution[key] == el:
+                    line_flags.append(2)
+                else:
+                    line_flags.append(1)
+                    el = substitution[key]
+                line_text.append(el)
+                line_xml.append(xml)
+            text.append(line_text)
+            flags.append(line_flags)
+            run_xml.append(line_xml)
 
-        paragraph = document.sections[0].header.paragraphs[0]
-        paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        paragraph.style.font.size = Pt(12)
-        paragraph.style.font.name = 'Times New Roman'
-        self._add_page_number(paragraph.add_run())
+        return {
+            'text': text,
+            'flags': flags,
+            'xml': run_xml
+        }
+
+    def _create_template_mask(self, template, _substitution, _sep):
+        compiled = self._compile_template(
+            template, _substitution.keys(), _sep)
+        return self._fill_template(compiled, _substitution)
 
-        self._set_appendix_styles(document)
-        return document
-            
     def _create_right_numeration(self, document):
         for s in document.sections:
             sectPr = s._sectPr
@@ -255,16 +352,16 @@ class Directive:
             sectPr.append(pgNumType)
             s.different_first_page_header_footer = True
 
+    @timeit('build_table')
     def _add_table(self, document, data, coordinates_title):
         table_section = document.add_section(WD_SECTION.CONTINUOUS)
         sectPr = table_section._sectPr
         cols = sectPr.xpath('./w:cols')[0]
         cols.set(qn('w:num'),'2')
 
-        h = len(data)
         w = len(data[0])
 
-        table = document.add_table(rows=h+3, cols=w, style='Table Grid')
+        table = document.add_table(rows=4, cols=w, style='Table Grid')
         table.style.font.name = 'Times New Roman'
         table.style.font.size = Pt(12)
         table.style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
@@ -273,19 +370,7 @@ class Directive:
         cells[0].merge(cells[3])
         cells[1].merge(cells[2])
 
-        index = coordinates_title.find(')', None)
-        if index:
-            coordinates_title = coordinates_title[:index+1]
-
-        head = [
-            'Обозначение характерных точек границ',
-            coordinates_title,
-            'X',
-            'Y',
-            '(1)',
-            '(2)',
-            '(3)'
-        ]
+        head = table_head(coordinates_title)
 
         head_cells = [0, 1, 4, 5, 6, 7, 8]
 
@@ -302,8 +387,10 @@ class Directive:
         table.rows[0].height = Cm(1.96)
 
         table.columns[0].width = Cm(4)
-        for i, c in enumerate(cells[9:]):
-            c.text = data[i//w][i%w]
+        if self.stream_rows is not None and len(data) >= self.stream_rows:
+            self._defer_table(table, data)
+        else:
+            self._fill_table(table, data)
 
         footer_section = document.add_section(WD_SECTION.CONTINUOUS)
         sectPr = footer_section._sectPr
@@ -314,5 +401,309 @@ class Directive:
         r = p.add_run()
         r.add_break(WD_BREAK.PAGE)
 
-        return document         
+        return document
 
+    def _serialize(self, element):
+        xml = etree.tostring(element, encoding='unicode')
+        return xml.replace(f' xmlns:w="{ns.nsmap["w"]}"', '')
+
+    def _run_xml(self, text, flag=0):
+        properties = ''
+        if flag in HIGHLIGHT_COLORS:
+            properties = (
+                f'<w:rPr><w:highlight w:val="{HIGHLIGHT_COLORS[flag]}"/></w:rPr>')
+        if not text:
+            content = ''
+        elif any(ch in text for ch in '\t\n\r'):
+            r = self._create_element('w:r')
+            r.text = text
+            content = self._serialize(r)[len('<w:r>'):-len('</w:r>')]
+        elif text != text.strip():
+            content = f'<w:t xml:space="preserve">{escape(text)}</w:t>'
+        else:
+            content = f'<w:t>{escape(text)}</w:t>'
+        if not properties and not content:
+            return '<w:r/>'
+        return f'<w:r>{properties}{content}</w:r>'
+
+    def _iter_row_xml(self, template, data, chunk_size=1000):
+        # The template is a blank row: its cell properties are kept and only
+        # the paragraphs are filled, chunk_size rows per yielded string.
+        parts = self._serialize(template).split('<w:p/>')
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            if hasattr(chunk, 'tolist'):
+                chunk = chunk.tolist()
+            rows = []
+            for row in chunk:
+                xml = [parts[0]]
+                for text, part in zip(row, parts[1:]):
+                    xml.append(f'<w:p>{self._run_xml(text)}</w:p>')
+                    xml.append(part)
+                rows.append(''.join(xml))
+            yield ''.join(rows)
+
+    def _fill_table(self, table, data, chunk_size=1000):
+        tbl = table._tbl
+        template = tbl.tr_lst[-1]
+        tbl.remove(template)
+        for rows in self._iter_row_xml(template, data, chunk_size):
+            chunk = parse_xml(f'<w:tbl {ns.nsdecls("w")}>{rows}</w:tbl>')
+            tbl.extend(list(chunk))
+
+    def _defer_table(self, table, data):
+        # The rows are left out of the tree, a comment marks where _save
+        # writes them straight into the zip entry of the document part.
+        tbl = table._tbl
+        template = tbl.tr_lst[-1]
+        marker = etree.Comment(f'{_ROWS_MARKER}{len(self._deferred_tables)}')
+        tbl.replace(template, marker)
+        self._deferred_tables.append((template, data))
+
+    @timeit('save_docx')
+    def _save(self, document, target, compress_level=DEFAULT_COMPRESS_LEVEL,
+            threads=SAVE_THREADS):
+        # target is a path, written through a temporary file, or a binary
+        # stream such as an in-memory buffer.
+        write_output(target, lambda f: self._write_package(
+            document, f, compress_level, threads))
+
+    def _write_package(self, document, f, compress_level, threads):
+        # The members python-docx would write, in the same order. Parts are
+        # serialized and compressed by a thread pool, large ones and the
+        # document part with deferred rows are streamed in CHUNK_SIZE pieces.
+        package = document.part.package
+        parts = list(package.iter_parts())
+        for part in parts:
+            part.before_marshal()
+        members = [
+            ('[Content_Types].xml',
+                lambda: _ContentTypesItem.from_parts(parts).blob),
+            ('_rels/.rels', lambda: package.rels.xml)]
+        for part in parts:
+            members.append((part.partname.membername, lambda p=part: p.blob))
+            if len(part.rels):
+                members.append((
+                    part.partname.rels_uri.membername,
+                    lambda p=part: p.rels.xml))
+
+        writer = ZipWriter(f, compress_level)
+
+        def prepare(name, serialize):
+            with span(f'serialize {name}'):
+                data = serialize()
+            if (len(data) >= 2 * CHUNK_SIZE and writer.level and
+                    executor is not None):
+                return data
+            with span(f'compress {name}'):
+                return writer.prepare(data)
+
+        executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        try:
+            jobs = []
+            for name, serialize in members:
+                if name == _DOCUMENT_PART and self._deferred_tables:
+                    jobs.append(None)
+                elif executor is not None:
+                    jobs.append(executor.submit(prepare, name, serialize))
+                else:
+                    jobs.append((name, serialize))
+            for (name, serialize), job in zip(members, jobs):
+                if job is None:
+                    with span(f'stream {name}'):
+                        self._stream_document(
+                            writer.open(name, executor, threads), serialize())
+                    continue
+                prepared = job.result() if executor is not None else prepare(*job)
+                if isinstance(prepared, bytes):
+                    with span(f'compress {name}'):
+                        stream = writer.open(name, executor, threads)
+                        stream.write(prepared)
+                        stream.close()
+                else:
+                    writer.add(name, prepared)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        writer.close()
+
+    def _stream_document(self, stream, blob):
+        pieces = re.split(f'<!--{_ROWS_MARKER}(\\d+)-->'.encode(), blob)
+        stream.write(pieces[0])
+        for i in range(1, len(pieces), 2):
+            template, data = self._deferred_tables[int(pieces[i])]
+            for rows in self._iter_row_xml(template, data):
+                stream.write(rows.encode('utf-8'))
+            stream.write(pieces[i + 1])
+        stream.close()
+
+
+class DirectiveVolume:
+
+    # Directives of many waterbodies in one docx. Package parts such as
+    # styles and the header are written once, from the first directive,
+    # and every directive body is streamed into the document part, so only
+    # one directive is held in memory at a time.
+
+    def __init__(self, _path, stream_rows=None,
+            compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.path = _path
+        self.stream_rows = stream_rows
+        self.compress_level = compress_level
+        self.count = 0
+        self._target = None
+        self._file = None
+        self._zip = None
+        self._part = None
+        self._tail = None
+        self._namespaces = []
+
+    def size(self):
+        return self._file.tell() if self._file is not None else 0
+
+    def _open(self, document):
+        self._target = AtomicFile(self.path, 'wb')
+        self._file = self._target.file
+        compression = ZIP_DEFLATED if self.compress_level else ZIP_STORED
+        self._zip = ZipFile(
+            self._file, 'w', compression, compresslevel=self.compress_level)
+        parts = {
+            p.partname[1:]: p for p in document.part.package.iter_parts()}
+        with ZipFile(BytesIO(Directive._base_document)) as source:
+            for info in source.infolist():
+                if info.filename == _DOCUMENT_PART:
+                    continue
+                part = parts.get(info.filename)
+                self._zip.writestr(
+                    info, part.blob if part is not None else source.read(info),
+                    compression, self.compress_level)
+        self._part = self._zip.open(_DOCUMENT_PART, 'w')
+
+        root = document.element
+        self._namespaces = [
+            f' xmlns:{prefix}="{uri}"' for prefix, uri in root.nsmap.items()]
+        shell = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+        etree.SubElement(shell, qn('w:body')).text = '|'
+        head, self._end = etree.tostring(
+            shell, xml_declaration=True, encoding='UTF-8',
+            standalone=True).split(b'|')
+        self._part.write(head)
+
+    def _write(self, element, directive):
+        xml = etree.tostring(element, encoding='unicode')
+        for declaration in self._namespaces:
+            xml = xml.replace(declaration, '')
+        pieces = re.split(f'<!--{_ROWS_MARKER}(\\d+)-->', xml)
+        self._part.write(pieces[0].encode('utf-8'))
+        for i in range(1, len(pieces), 2):
+            template, data = directive._deferred_tables[int(pieces[i])]
+            for rows in directive._iter_row_xml(template, data):
+                self._part.write(rows.encode('utf-8'))
+            self._part.write(pieces[i + 1].encode('utf-8'))
+
+    def _write_tail(self, last):
+        # The closing page break of a directive is dropped. If another
+        # directive follows, the final section properties move into the
+        # last paragraph, so every directive keeps its own sections and
+        # page numbering starting from 1.
+        paragraph, sectPr = self._tail
+        self._tail = None
+        if not last:
+            paragraph.get_or_add_pPr().append(sectPr)
+        self._write(paragraph, None)
+        if last:
+            self._write(sectPr, None)
+
+    @timeit('append_volume')
+    def add(self, model):
+        directive = Directive(self.stream_rows)
+        document = directive._render(model)
+        if self._file is None:
+            self._open(document)
+        elif self._tail is not None:
+            self._write_tail(False)
+        children = list(document.element.body)
+        sectPr = children.pop()
+        paragraph = children.pop()
+        for br in paragraph.xpath('.//w:br[@w:type="page"]'):
+            br.getparent().remove(br)
+        for child in children:
+            self._write(child, directive)
+        self._tail = (paragraph, sectPr)
+        self.count += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self._write_tail(True)
+            self._part.write(self._end)
+            self._part.close()
+            self._zip.close()
+            self._target.commit()
+        except BaseException:
+            self._target.discard()
+            raise
+        finally:
+            self._target = None
+            self._file = None
+
+    def discard(self):
+        if self._target is not None:
+            self._target.discard()
+            self._target = None
+            self._file = None
+
+
+class DirectiveVolumes:
+
+    # Splits a run of directives into volumes of about volume_size bytes.
+    # A directive is never split between two volumes.
+
+    def __init__(self, base_path, volume_size=None, stream_rows=None,
+            compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.stream_rows = stream_rows
+        self.compress_level = compress_level
+        self.paths = []
+        self._volume = None
+
+    def _volume_path(self, number):
+        if self.volume_size is None:
+            return f'{self.base_path}.docx'
+        return f'{self.base_path} {number}.docx'
+
+    def add(self, model):
+        if self._volume is None:
+            self._volume = DirectiveVolume(
+                self._volume_path(len(self.paths) + 1), self.stream_rows,
+                self.compress_level)
+        try:
+            self._volume.add(model)
+        except BaseException:
+            # A volume nothing was appended to is not written at all.
+            if not self._volume.count:
+                self._volume.discard()
+                self._volume = None
+            raise
+        _path = self._volume.path
+        if self.volume_size is not None and self._volume.size() >= self.volume_size:
+            self._finish_volume()
+        return _path
+
+    def _finish_volume(self):
+        self._volume.close()
+        self.paths.append(self._volume.path)
+        self._volume = None
+
+    def close(self):
+        if self._volume is not None:
+            self._finish_volume()
+        if self.volume_size is not None:
+            # Volumes left over from an earlier, longer run.
+            number = len(self.paths) + 1
+            while exists(self._volume_path(number)):
+                remove(self._volume_path(number))
+                number += 1
+        return self.paths
@@ -1,50 +1,98 @@
-from os import walk
-from os.path import abspath, relpath, splitext, join, basename
-
-from time import perf_counter
-
-import openpyxl
-from docx import Document
-from docx.oxml import OxmlElement, ns
-from docx.oxml.ns import qn
-from docx.shared import Cm, Pt
-from docx.enum.style import WD_STYLE_TYPE
-from docx.enum.section import WD_SECTION
-from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_COLOR_INDEX, WD_BREAK
-from docx.enum.table import WD_ALIGN_VERTICAL
-
-from directive import Directive
-
-def timeit(operation, _end):
-    def decorator(method):
-        def wrapped(*args, **kwargs):
-            base_name = basename(kwargs['_path'])
-            print(f'{operation} <{base_name}>...', end=_end)
-            time_start = perf_counter()
-            result = method(*args, **kwargs)
-            time_finish = (perf_counter() - time_start)*1e3
-            print(f'{operation} <{base_name}> done in {time_finish:.3f} ms.')
-            return result
-        return wrapped
-    return decorator
+from os.path import abspath, relpath, splitext, join, basename, dirname, isdir, sep
 
-def create_xlsx_file_list(target_dir):
-    result = []
-    for root, dirs, files in walk(target_dir):
-        for f in files:
-            ap_file = abspath(join(root, f))
-            filename, ext = splitext(ap_file)
-            if ext == '.xlsx':
-                result.append(ap_file)
-    return result
+from argparse import ArgumentParser
+import csv
+import sys
+from datetime import datetime
+from itertools import islice
+from queue import Queue
+from threading import Thread
+from time import monotonic, perf_counter
+
+from atomic import write_atomically
+from batch import Journal, WorkerPool, write_run_report
+from cache import DEFAULT_CACHE_SIZE, CoordinateCache
+import instrumentation
+from instrumentation import span, timeit
+from manifest import (
+    DIRECTIVE_NAME, EXPORT_EXTENSIONS, hash_files, is_up_to_date,
+    output_files, write_manifest)
+from render import DOCUMENT_FORMATS, render_documents
+from reuse import REUSE_MODES, CatalogMemo, content_digest
+from scanner import build_index, find_candidates, walk_tree
+import validation
+from validation import validate_catalog
+from zipwriter import DEFAULT_COMPRESS_LEVEL, SAVE_THREADS
+
+DIRECTIVE_TEMPLATE = 'directive_template.txt'
+APPENDIX_TEMPLATE = 'appendix_template.txt'
+SUBSTITUTION_KEYS = ['WBN', 'DN', 'WBL', 'WPZ', 'PSB']
+APPENDIX_NUMBERS = ['1', '2', '3', '23']
+EXPORT_FORMATS = ['tsv', 'csv', 'bin']
+RESULT_STATUSES = ['rebuilt', 'skipped', 'resumed', 'failed']
+LAYOUTS = {
+    'catalog': [
+        'каталог координат БЛ.xlsx',
+        'каталог координат ВОЗ.xlsx',
+        'каталог координат ПЗП.xlsx',
+        'content.txt'
+    ],
+    'appendix': [
+        'Приложение 1.xlsx',
+        'Приложение 2.xlsx',
+        'Приложение 3.xlsx',
+        'content.txt'
+    ],
+}
+DEFAULT_TARGET_DIR = './data/Проекты распоряжений/Рузский район'
+WRITE_CHUNK_ROWS = 10000
+# Appendix tables from this many rows on are streamed into Directive.docx.
+STREAM_ROWS = 5000
+CONSOLIDATED_NAME = 'Directives'
+# Seconds a waterbody has to stay unchanged in watch mode before it is
+# rebuilt, so a burst of saves leads to one rebuild.
+DEBOUNCE = 2.0
+
+# openpyxl, NumPy and python-docx are imported by the stages that use them,
+# so a scan or an up-to-date run does not pay for loading them.
 
-@timeit('Reading', '\r')
+def create_xlsx_file_list(target_dir, threads=8):
+    tree = walk_tree(target_dir, threads)
+    return [
+        join(d, f) for d in sorted(tree) for f in tree[d]['files']
+        if splitext(f)[1] == '.xlsx'
+    ]
+
+def iter_xlsx_rows(_path):
+    import openpyxl
+
+    wb = openpyxl.load_workbook(_path, read_only=True)
+    try:
+        sheet = wb.active
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(values_only=True):
+            if any(el is not None for el in row):
+                yield row
+    finally:
+        wb.close()
+
+@timeit('read_xlsx')
 def read_xlsx(_path):
-    wb = openpyxl.load_workbook(_path)
-    sheet = wb.active
-    rows = sheet.rows
-    data = [[cell.value for cell in row] for row in sheet.rows]
-    return [row for row in data if row != [None for el in row]]
+    return [list(row) for row in iter_xlsx_rows(_path)]
+
+def iter_xlsx_coordinates(_path, title_row=2, first_row=5, columns=3):
+    padding = (None,) * columns
+    for i, row in enumerate(iter_xlsx_rows(_path)):
+        if i == title_row:
+            yield row[1]
+        elif i >= first_row:
+            yield (row + padding)[:columns]
+
+@timeit('read_xlsx')
+def read_xlsx_coordinates(_path):
+    rows = iter_xlsx_coordinates(_path)
+    title = next(rows, None)
+    return title, list(rows)
 
 def extract_columns(data, columns):
     return [[row[el] for el in columns] for row in data] 
@@ -61,26 +109,102 @@ def convert_data_to_str(data, formatting):
     ]
 
 
-def scan_directory(target_dir, filenames):
-    result = dict()
-    for root, dirs, files in walk(target_dir):
-        found_files = [f for f in files if f in filenames]
-        found_files.sort()
-        if found_files == filenames:
-            result[f'{abspath(root)}'] = found_files
+@timeit('scan_directory')
+def scan_directory(target_dir, filenames, threads=8, index_file=None):
+    tree, candidates = build_index(target_dir, filenames, threads, index_file)
+    result = complete_waterbodies(candidates)
     print(*list(result.keys()), sep='\n')
     return result
 
-@timeit('Writing', '\r')
+def complete_waterbodies(candidates):
+    result = dict()
+    for directory, candidate in candidates.items():
+        if candidate['missing']:
+            missing = ', '.join(candidate['missing'])
+            print(f'Incomplete <{directory}>: missing {missing}.')
+        else:
+            result[directory] = candidate['files']
+    return result
+
+def iter_row_chunks(data, chunk_size=WRITE_CHUNK_ROWS):
+    if hasattr(data, 'tolist'):
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size].tolist()
+    else:
+        rows = iter(data)
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(rows, chunk_size))
+
+@timeit('write_txt')
 def write_txtfile(data, sep, _path):
+    def write(f):
+        for chunk in iter_row_chunks(data):
+            f.write(''.join([f'{sep.join(row)}\n' for row in chunk]))
+    try:
+        write_atomically(write, _path)
+    except IOError:
+        print(f'I/O error with <{_path}>.')
+        return False
+    return True
+
+@timeit('write_csv')
+def write_csvfile(data, header, _path):
+    def write(f):
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for chunk in iter_row_chunks(data):
+            writer.writerows(chunk)
+    try:
+        write_atomically(write, _path, newline='')
+    except IOError:
+        print(f'I/O error with <{_path}>.')
+        return False
+    return True
+
+@timeit('write_bin')
+def write_binfile(records, _path):
     try:
-        with open(_path, 'w') as f:
-            for row in data:
-                f.write(f"{sep.join(row)}\n")
+        write_atomically(records.tofile, _path, mode='wb')
     except IOError:
         print(f'I/O error with <{_path}>.')
+        return False
+    return True
 
-@timeit('Reading', '\r')
+def export_coordinates(coordinates, str_coordinates, _path, formats=('tsv',),
+        memo=None):
+    # Every writer tells whether its file was written, the memo only reuses
+    # exports that were.
+    def write_tsv():
+        return write_txtfile(
+            str_coordinates[:, 1:], sep='\t', _path=change_ext(_path, 'txt'))
+
+    def write_csv():
+        return write_csvfile(
+            coordinates.format(separator='.'), ['id', 'x', 'y'],
+            _path=change_ext(_path, 'csv'))
+
+    def write_bin():
+        records = coordinates.to_records()
+        if records is None:
+            print(f'<{_path}> has non-numeric cells - binary export skipped.')
+            return False
+        return write_binfile(records, _path=change_ext(_path, 'bin'))
+
+    writers = {'tsv': write_tsv, 'csv': write_csv, 'bin': write_bin}
+    for f in EXPORT_FORMATS:
+        if f not in formats:
+            continue
+        if memo is None:
+            writers[f]()
+        else:
+            ext = EXPORT_EXTENSIONS[f]
+            with span('reuse_export'):
+                memo.export(
+                    coordinates, ext, change_ext(_path, ext), writers[f])
+
+@timeit('read_text')
 def read_textfile(_path):
     try:
         with open(_path, 'r', encoding='utf-8') as f:
@@ -141,118 +265,771 @@ def create_appendix_content(framework, appendix_number):
         result.append(framework[i])
     return result
 
-def write_docx_file(document, output_file):
-    try:
-        document.save(output_file)
-    except PermissionError:
-        print(f'<{output_file}> is busy - permission denied.')
+# Compiled directive and appendix variants of the current templates,
+# keyed by template digest.
+_template_variants = {}
+
+def template_variants(directive_template, appendix_framework, template_digest):
+    # Both directive variants and all four appendix variants are numbered
+    # and compiled once per version of the template files, leaving only the
+    # substitutions to each waterbody. A new digest drops the old variants.
+    from directive import Directive
 
-@timeit('Processing', '\n')
-def process_waterbody(filenames, directive_template, appendix_framework, _path):
-    # print(f'Start processing <.{relpath(target_dir, ".")}>:')
+    variants = _template_variants.get(template_digest)
+    if variants is None:
+        directive = Directive()
+        variants = {
+            'directive': {
+                equal: directive._compile_template(
+                    create_directive_text(directive_template, equal),
+                    SUBSTITUTION_KEYS, '#')
+                for equal in [False, True]},
+            'appendix': {
+                n: directive._compile_template(
+                    create_appendix_content(appendix_framework, n),
+                    SUBSTITUTION_KEYS, '#')
+                for n in APPENDIX_NUMBERS}
+        }
+        _template_variants.clear()
+        _template_variants[template_digest] = variants
+    return variants
 
+def read_catalog(_path, cache=None, memo=None, digest=None):
+    if memo is None:
+        return load_catalog(_path, cache, digest)
+    if digest is None:
+        with span('digest_catalog'):
+            digest = content_digest(_path)
+    found = memo.catalog(digest)
+    if found is None:
+        found = load_catalog(_path, cache, digest)
+        memo.add_catalog(digest, *found)
+    return found
+
+def load_catalog(_path, cache=None, digest=None):
+    from coordinates import to_coordinates
+
+    if cache is None:
+        title, data = read_xlsx_coordinates(_path=_path)
+        return title, to_coordinates(data)
+    with span('read_cache'):
+        key, cached = cache.load(_path, digest)
+    if cached is not None:
+        return cached
+    title, data = read_xlsx_coordinates(_path=_path)
+    coordinates = to_coordinates(data)
+    cache.store(key, title, coordinates)
+    return title, coordinates
+
+@timeit('read_waterbody')
+def read_waterbody(filenames, _path, cache=None, memo=None, file_digests=None):
     content_txt = read_textfile(_path=join(_path, 'content.txt'))
-    subst_keys = ['WBN', 'DN', 'WBL', 'WPZ', 'PSB']
-    substitution = {k:f'{{{k}}}' for k in subst_keys}
+    substitution = {k:f'{{{k}}}' for k in SUBSTITUTION_KEYS}
     if content_txt:
-        # for k, c in zip(subst_keys[1:], content_txt[1:]):
-        for k, c in zip(subst_keys, content_txt):
+        # for k, c in zip(SUBSTITUTION_KEYS[1:], content_txt[1:]):
+        for k, c in zip(SUBSTITUTION_KEYS, content_txt):
             substitution[k] = c
 
-    waterbody_name = substitution['WBN']
-
     xlsx_files = [f for f in filenames if splitext(f)[1] == '.xlsx']
     xlsx_files.sort()
-    appendix_document = Document()
-    xlsx_data = []
+    coordinates = []
     coordinates_title = []
-    appendix_numbers = []
-    for i, f in enumerate(xlsx_files, 1):
-        appendix_numbers.append(str(i))
-        data = read_xlsx(_path=join(_path, f))
-        xlsx_data.append(data)
-        coordinates_title.append(data[2][1])
-    coordinates = [extract_columns(el[5:], [0, 1, 2]) for el in xlsx_data]
-    formatting = ['{:.0f}', '{:.2f}', '{:.2f}']
-    str_coordinates = [convert_data_to_str(el, formatting) for el in coordinates]
+    for f in xlsx_files:
+        digest = file_digests.get(f) if file_digests else None
+        title, catalog = read_catalog(join(_path, f), cache, memo, digest)
+        coordinates.append(catalog)
+        coordinates_title.append(title)
+    return {
+        'path': _path,
+        'substitution': substitution,
+        'xlsx_files': xlsx_files,
+        'coordinates': coordinates,
+        'coordinates_title': coordinates_title
+    }
 
-    for f, d in zip(xlsx_files, str_coordinates):
-        new_filename = change_ext(f, 'txt')
-        write_txtfile(extract_columns(d, [1, 2]), _path=join(_path, new_filename), sep='\t')
+@timeit('build_waterbody')
+def build_waterbody(waterbody, directive_template, appendix_framework,
+        template_digest, tolerance=0.0, memo=None):
+    from coordinates import catalogs_equal
+    from directive import Directive
 
+    substitution = waterbody['substitution']
+    coordinates = waterbody['coordinates']
+    coordinates_title = waterbody['coordinates_title']
+    with span('validate'):
+        for f, c in zip(waterbody['xlsx_files'], coordinates):
+            validation.record(waterbody['path'], f, validate_catalog(c))
+    appendix_numbers = [str(i) for i in range(1, len(coordinates) + 1)]
+    with span('format_coordinates'):
+        if memo is None:
+            str_coordinates = [el.format() for el in coordinates]
+        else:
+            str_coordinates = [memo.format(el) for el in coordinates]
 
     appendixes_2_and_3_are_equal = False
-    if coordinates[1] == coordinates[2]:
+    if catalogs_equal(coordinates[1], coordinates[2], tolerance):
         appendix_numbers = ['1', '23']
         appendixes_2_and_3_are_equal = True
     
-    directive_text = create_directive_text(directive_template, appendixes_2_and_3_are_equal)
-    directive = Directive()
-    doc = directive._create_directive(directive_text, substitution)
-    directive._set_page_properties(doc)
-  
-    for c, c_t, n in zip(str_coordinates, coordinates_title, appendix_numbers):
-        a_c = create_appendix_content(appendix_framework, n)
-        doc = directive._add_appendix(doc, a_c, substitution)
-        doc = directive._add_table(doc, c, c_t)
-
-    directive._create_right_numeration(doc)
-
-    doc.save(join(_path, 'Directive.docx'))
-
-@timeit('Processing', '\n')
-def process_directory(filenames, _path):
-    dir_content = scan_directory(_path, filenames)
-
-    directive_template = read_textfile(_path='directive_template.txt')
-    appendix_content = read_textfile(_path='appendix_template.txt')
+    with span('build_model'):
+        variants = template_variants(
+            directive_template, appendix_framework, template_digest)
+        appendices = [
+            (variants['appendix'][n], c, c_t)
+            for c, c_t, n in zip(
+                str_coordinates, coordinates_title, appendix_numbers)]
+        model = Directive()._create_model(
+            variants['directive'][appendixes_2_and_3_are_equal],
+            substitution, appendices)
+
+    waterbody['str_coordinates'] = str_coordinates
+    waterbody['model'] = model
+    return waterbody
+
+@timeit('write_waterbody')
+def write_waterbody(waterbody, export_formats=('tsv',), memo=None,
+        document_formats=('docx',), stream_rows=STREAM_ROWS,
+        save_options=None):
+    _path = waterbody['path']
+    for f, c, d in zip(
+            waterbody['xlsx_files'], waterbody['coordinates'],
+            waterbody['str_coordinates']):
+        export_coordinates(c, d, join(_path, f), export_formats, memo)
+
+    render_documents(
+        waterbody['model'], join(_path, DIRECTIVE_NAME), document_formats,
+        stream_rows, save_options)
+
+@timeit('process_waterbody')
+def process_waterbody(filenames, directive_template, appendix_framework, _path,
+        template_digest, tolerance=0.0, export_formats=('tsv',), cache=None,
+        stream_rows=STREAM_ROWS, memo=None, document_formats=('docx',),
+        save_options=None, file_digests=None):
+    waterbody = read_waterbody(
+        filenames, _path=_path, cache=cache, memo=memo,
+        file_digests=file_digests)
+    build_waterbody(
+        waterbody, directive_template, appendix_framework, template_digest,
+        tolerance, memo)
+    write_waterbody(
+        waterbody, export_formats, memo, document_formats, stream_rows,
+        save_options)
+
+def check_waterbody(filenames, directory, template_digest, force=False,
+        export_formats=('tsv',), document_formats=('docx',), tolerance=0.0):
+    inputs = [join(directory, f) for f in filenames]
+    # A tolerance can merge appendices 2 and 3, so it is part of the digest.
+    seed = f'{template_digest}:{tolerance!r}' if tolerance else template_digest
+    file_digests = {}
+    digest = hash_files(inputs, seed=seed, file_digests=file_digests)
+    outputs = output_files(filenames, export_formats, document_formats)
+    up_to_date = not force and is_up_to_date(directory, digest, outputs)
+    return digest, outputs, up_to_date, file_digests
+
+def _failure(directory, error):
+    return directory, 'failed', f'{type(error).__name__}: {error}'
+
+def run_waterbody(filenames, directive_template, appendix_framework, directory,
+        template_digest, force=False, export_formats=('tsv',), cache=None,
+        stream_rows=STREAM_ROWS, memo=None, document_formats=('docx',),
+        save_options=None, tolerance=0.0):
+    try:
+        digest, outputs, up_to_date, file_digests = check_waterbody(
+            filenames, directory, template_digest, force, export_formats,
+            document_formats, tolerance)
+        if up_to_date:
+            return directory, 'skipped', None
+        time_start = perf_counter()
+        process_waterbody(
+            filenames, directive_template, appendix_framework, _path=directory,
+            template_digest=template_digest, tolerance=tolerance,
+            export_formats=export_formats, cache=cache,
+            stream_rows=stream_rows, memo=memo,
+            document_formats=document_formats, save_options=save_options,
+            file_digests=file_digests)
+        write_manifest(directory, digest, outputs)
+        time_finish = (perf_counter() - time_start)*1e3
+        print(f'Processing <{basename(directory)}> done in {time_finish:.3f} ms.')
+    except Exception as e:
+        return _failure(directory, e)
+    return directory, 'rebuilt', None
+
+_PIPELINE_DONE = None
+
+def run_pipeline(dir_content, directories, directive_template,
+        appendix_framework, template_digest, force=False,
+        export_formats=('tsv',), depth=2, cache=None, on_result=None,
+        stream_rows=STREAM_ROWS, memo=None, document_formats=('docx',),
+        save_options=None, tolerance=0.0):
+    # Reading, building and saving run in three threads connected by
+    # bounded queues, so at most 2 * depth + 3 waterbodies are in memory.
+    read_queue = Queue(maxsize=depth)
+    write_queue = Queue(maxsize=depth)
+    results = {}
+
+    def finish(result):
+        results[result[0]] = result
+        if on_result is not None:
+            on_result(result)
+
+    def read_stage():
+        for directory in directories:
+            try:
+                digest, outputs, up_to_date, file_digests = check_waterbody(
+                    dir_content[directory], directory, template_digest,
+                    force, export_formats, document_formats, tolerance)
+                if up_to_date:
+                    finish((directory, 'skipped', None))
+                    continue
+                time_start = perf_counter()
+                waterbody = read_waterbody(
+                    dir_content[directory], _path=directory, cache=cache,
+                    memo=memo, file_digests=file_digests)
+                read_queue.put((waterbody, digest, outputs, time_start))
+            except Exception as e:
+                finish(_failure(directory, e))
+        read_queue.put(_PIPELINE_DONE)
+
+    def build_stage():
+        while (item := read_queue.get()) is not _PIPELINE_DONE:
+            waterbody = item[0]
+            try:
+                build_waterbody(
+                    waterbody, directive_template, appendix_framework,
+                    template_digest, tolerance, memo)
+                write_queue.put(item)
+            except Exception as e:
+                finish(_failure(waterbody['path'], e))
+        write_queue.put(_PIPELINE_DONE)
+
+    def write_stage():
+        while (item := write_queue.get()) is not _PIPELINE_DONE:
+            waterbody, digest, outputs, time_start = item
+            directory = waterbody['path']
+            try:
+                write_waterbody(
+                    waterbody, export_formats, memo, document_formats,
+                    stream_rows, save_options)
+                write_manifest(directory, digest, outputs)
+                time_finish = (perf_counter() - time_start)*1e3
+                print(f'Processing <{basename(directory)}> done in {time_finish:.3f} ms.')
+                finish((directory, 'rebuilt', None))
+            except Exception as e:
+                finish(_failure(directory, e))
+
+    stages = [
+        Thread(target=stage, daemon=True)
+        for stage in [read_stage, build_stage, write_stage]]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    return [results[d] for d in directories]
+
+@timeit('consolidate_waterbodies')
+def consolidate_waterbodies(dir_content, directories, directive_template,
+        appendix_framework, template_digest, base_path, force=False,
+        export_formats=('tsv',), cache=None, stream_rows=STREAM_ROWS,
+        memo=None, volume_size=None, on_result=None, tolerance=0.0,
+        compress_level=DEFAULT_COMPRESS_LEVEL):
+    from directive import DirectiveVolumes
+
+    # Directives are appended in directory order into shared volumes, so
+    # every waterbody is read and built, even if its exports are up to date.
+    volumes = DirectiveVolumes(
+        base_path, volume_size, stream_rows, compress_level)
+    results = []
+    for directory in directories:
+        try:
+            digest, outputs, up_to_date, file_digests = check_waterbody(
+                dir_content[directory], directory, template_digest, force,
+                export_formats, (), tolerance)
+            time_start = perf_counter()
+            waterbody = read_waterbody(
+                dir_content[directory], _path=directory, cache=cache,
+                memo=memo, file_digests=file_digests)
+            build_waterbody(
+                waterbody, directive_template, appendix_framework,
+                template_digest, tolerance, memo)
+            if not up_to_date:
+                write_waterbody(waterbody, export_formats, memo, ())
+                write_manifest(directory, digest, outputs)
+            volume = volumes.add(waterbody['model'])
+            time_finish = (perf_counter() - time_start)*1e3
+            print(f'Appending <{basename(directory)}> to <{basename(volume)}> done in {time_finish:.3f} ms.')
+            result = (directory, 'skipped' if up_to_date else 'rebuilt', None)
+        except Exception as e:
+            result = _failure(directory, e)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+    for _path in volumes.close():
+        print(f'Consolidated directives in <{_path}>.')
+    return results
+
+_worker_templates = None
+_worker_cache = None
+_worker_memo = None
+
+def _init_worker(directive_template, appendix_framework, template_digest,
+        instrumentation_settings, cache_settings, reuse):
+    global _worker_templates, _worker_cache, _worker_memo
+    _worker_templates = (directive_template, appendix_framework, template_digest)
+    if instrumentation_settings is not None:
+        instrumentation.enable(**instrumentation_settings)
+    if cache_settings is not None:
+        _worker_cache = CoordinateCache(*cache_settings)
+    if reuse != 'off':
+        _worker_memo = CatalogMemo(reuse)
+
+def _run_waterbody_in_worker(filenames, directory, force, export_formats,
+        stream_rows, document_formats, save_options, tolerance):
+    directive_template, appendix_framework, template_digest = _worker_templates
+    result = run_waterbody(
+        filenames, directive_template, appendix_framework, directory,
+        template_digest, force, export_formats, _worker_cache, stream_rows,
+        _worker_memo, document_formats, save_options, tolerance)
+    cache_stats = _worker_cache.drain_stats() if _worker_cache else (0, 0)
+    return (
+        result, instrumentation.drain_samples(), cache_stats,
+        validation.drain_catalogs())
+
+def scan_waterbodies(filenames, _path, scan_threads=8, index_file=None,
+        force=False, export_formats=('tsv',), document_formats=('docx',),
+        tolerance=0.0):
+    dir_content = scan_directory(_path, filenames, scan_threads, index_file)
+    template_digest = hash_files([DIRECTIVE_TEMPLATE, APPENDIX_TEMPLATE])
+    stale = []
+    for directory in sorted(dir_content):
+        digest, outputs, up_to_date, file_digests = check_waterbody(
+            dir_content[directory], directory, template_digest, force,
+            export_formats, document_formats, tolerance)
+        if not up_to_date:
+            print(f'Out of date <{directory}>.')
+            stale.append(directory)
+    print(f'{len(stale)} of {len(dir_content)} directories need rebuilding.')
+    return stale
+
+def report_results(results, cache_stats=None):
+    statuses = [s for d, s, e in results]
+    counts = ', '.join(
+        f'{s} {statuses.count(s)}' for s in RESULT_STATUSES
+        if s in statuses or s != 'resumed')
+    print(f'{counts.capitalize()} of {len(results)} directories.')
+    for directory, status, error in results:
+        if error is not None:
+            print(f'Failed <{directory}>: {error}')
+    if cache_stats is not None:
+        print(f'Coordinate cache: {cache_stats[0]} hits, {cache_stats[1]} misses.')
+
+def load_templates():
+    directive_template = read_textfile(_path=DIRECTIVE_TEMPLATE)
+    appendix_content = read_textfile(_path=APPENDIX_TEMPLATE)
+    template_digest = hash_files([DIRECTIVE_TEMPLATE, APPENDIX_TEMPLATE])
     
     appendix_framework = create_document_framework(
         appendix_content,
         [0, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14],
         ['\n', '', '', '', '', '', '', '', '', '']
     )
+    return directive_template, appendix_framework, template_digest
+
+@timeit('process_directory')
+def process_directory(filenames, _path, jobs=1, force=False, scan_threads=8,
+        index_file=None, export_formats=('tsv',), pipeline_depth=0,
+        cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, timeout=None,
+        journal=None, stream_rows=STREAM_ROWS, reuse='link',
+        document_formats=('docx',), consolidate=None, volume_size=None,
+        save_options=None, tolerance=0.0):
+    dir_content = scan_directory(_path, filenames, scan_threads, index_file)
+    directories = sorted(dir_content)
+
+    directive_template, appendix_framework, template_digest = load_templates()
+
+    cache = None
+    cache_settings = None
+    if cache_dir is not None:
+        cache_settings = (cache_dir, cache_size)
+        cache = CoordinateCache(*cache_settings)
+    hits, misses = 0, 0
+    memo = CatalogMemo(reuse) if reuse != 'off' else None
+
+    results = {}
+    pending = []
+    for directory in directories:
+        if journal is not None and journal.is_done(directory):
+            results[directory] = (directory, 'resumed', None)
+        else:
+            pending.append(directory)
+
+    def finish(result):
+        results[result[0]] = result
+        if journal is not None:
+            journal.record(result)
+
+    if consolidate is not None:
+        consolidate_waterbodies(
+            dir_content, pending, directive_template, appendix_framework,
+            template_digest, join(_path, consolidate), force, export_formats,
+            cache, stream_rows, memo, volume_size, on_result=finish,
+            tolerance=tolerance,
+            compress_level=(save_options or {}).get(
+                'compress_level', DEFAULT_COMPRESS_LEVEL))
+    elif jobs > 1 or timeout:
+        # A timeout needs a worker process that can be killed, so it
+        # always goes through the pool, even with a single job.
+        pool = WorkerPool(
+            jobs, initializer=_init_worker,
+            initargs=(
+                directive_template, appendix_framework, template_digest,
+                instrumentation.settings(), cache_settings, reuse),
+            timeout=timeout)
+        tasks = [
+            (d, (
+                dir_content[d], d, force, export_formats, stream_rows,
+                document_formats, save_options, tolerance))
+            for d in pending]
+        for directory, ok, value in pool.run(_run_waterbody_in_worker, tasks):
+            if not ok:
+                finish((directory, 'failed', value))
+                continue
+            result, samples, cache_stats, catalogs = value
+            instrumentation.merge_samples(samples)
+            validation.merge_catalogs(catalogs)
+            hits += cache_stats[0]
+            misses += cache_stats[1]
+            finish(result)
+    elif pipeline_depth > 0:
+        run_pipeline(
+            dir_content, pending, directive_template, appendix_framework,
+            template_digest, force, export_formats, pipeline_depth, cache,
+            on_result=finish, stream_rows=stream_rows, memo=memo,
+            document_formats=document_formats, save_options=save_options,
+            tolerance=tolerance)
+    else:
+        for directory in pending:
+            finish(run_waterbody(
+                dir_content[directory], directive_template,
+                appendix_framework, directory, template_digest, force,
+                export_formats, cache, stream_rows, memo, document_formats,
+                save_options, tolerance))
+
+    cache_stats = None
+    if cache is not None:
+        cache.prune()
+        cache_hits, cache_misses = cache.drain_stats()
+        cache_stats = (hits + cache_hits, misses + cache_misses)
+    results = [results[d] for d in directories]
+    report_results(results, cache_stats)
+    return results
+
+def watch_directories(filenames, targets, jobs=1, scan_threads=8,
+        index_file=None, export_formats=('tsv',), cache_dir=None,
+        cache_size=DEFAULT_CACHE_SIZE, journal=None, stream_rows=STREAM_ROWS,
+        reuse='link', document_formats=('docx',), debounce=DEBOUNCE,
+        poll_interval=None, save_options=None, tolerance=0.0):
+    from concurrent.futures import ThreadPoolExecutor
+    from watcher import create_watcher
+
+    # The directory index stays in memory and only the directories a change
+    # lands in are relisted and rebuilt. Every known waterbody is queued once
+    # at start, up-to-date ones are skipped by their manifest.
+    roots = [abspath(t) for t in targets]
+    tree = {}
+    dir_content = {}
+    for root in roots:
+        root_tree, candidates = build_index(
+            root, filenames, scan_threads, index_file)
+        tree.update(root_tree)
+        dir_content.update(complete_waterbodies(candidates))
+    template_paths = {abspath(DIRECTIVE_TEMPLATE), abspath(APPENDIX_TEMPLATE)}
+    templates = load_templates()
+    cache = CoordinateCache(cache_dir, cache_size) if cache_dir else None
+    memo = CatalogMemo(reuse) if reuse != 'off' else None
 
-    for directory, files in dir_content.items():
-        process_waterbody(files, directive_template, appendix_framework, _path=directory)
+    def rescan(directory):
+        subtree = walk_tree(directory, 1, tree)
+        below = [
+            d for d in tree if d == directory or d.startswith(directory + sep)]
+        for d in below:
+            del tree[d]
+            dir_content.pop(d, None)
+        tree.update(subtree)
+        found = complete_waterbodies(find_candidates(subtree, filenames))
+        dir_content.update(found)
+        return sorted(found)
+
+    # Directories waiting for their changes to settle, keyed to the time of
+    # the last change; None stands for the templates.
+    pending = {d: 0 for d in dir_content}
+    running = {}
+    dirty = set()
+    watcher = create_watcher(
+        roots, list(tree), filenames, template_paths, poll_interval)
+    print(f'Watching {len(dir_content)} waterbodies, press Ctrl+C to stop.')
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        try:
+            while True:
+                for directory, future in list(running.items()):
+                    if not future.done():
+                        continue
+                    del running[directory]
+                    result = future.result()
+                    if result[1] == 'failed':
+                        print(f'Failed <{directory}>: {result[2]}')
+                    # Findings are shown as jobs finish, so they do not
+                    # pile up for as long as the watch runs.
+                    catalogs = validation.drain_catalogs()
+                    if catalogs:
+                        validation.print_findings(catalogs)
+                    if journal is not None:
+                        journal.record(result)
+                    if directory in dirty:
+                        dirty.discard(directory)
+                        pending[directory] = 0
+
+                now = monotonic()
+                for key in [k for k, t in pending.items() if now - t >= debounce]:
+                    del pending[key]
+                    if key is None:
+                        # A template can be briefly missing, e.g. while a
+                        # checkout runs. The current templates stay in use
+                        # and the next change to them retries.
+                        try:
+                            reloaded = load_templates()
+                            if None in reloaded[:2]:
+                                raise ValueError('template could not be read')
+                        except (OSError, TypeError, ValueError) as e:
+                            print(f'Templates kept, reloading failed: {e}.')
+                            continue
+                        if reloaded[2] == templates[2]:
+                            continue
+                        print('Templates changed, rebuilding every waterbody.')
+                        templates = reloaded
+                        pending.update((d, 0) for d in dir_content)
+                        continue
+                    for directory in rescan(key):
+                        if directory in running:
+                            # Rebuilt again once the running job is done.
+                            dirty.add(directory)
+                            continue
+                        directive_template, appendix_framework, template_digest = templates
+                        running[directory] = executor.submit(
+                            run_waterbody, dir_content[directory],
+                            directive_template, appendix_framework, directory,
+                            template_digest, False, export_formats, cache,
+                            stream_rows, memo, document_formats, save_options,
+                            tolerance)
+
+                waits = [debounce - (now - t) for t in pending.values()]
+                if waits:
+                    timeout = max(0.05, min(waits))
+                elif running:
+                    timeout = 0.2
+                else:
+                    timeout = None
+                for _path in watcher.changes(timeout):
+                    now = monotonic()
+                    if _path in template_paths:
+                        pending[None] = now
+                    elif basename(_path) in filenames:
+                        pending[dirname(_path)] = now
+                    elif _path in tree or isdir(_path):
+                        pending[_path] = now
+        except KeyboardInterrupt:
+            print('Stopping, waiting for running waterbodies.')
+        finally:
+            watcher.close()
+    if cache is not None:
+        cache.prune()
 
 if __name__ == '__main__':
-    # target_dir = './data/26_река_Нахавня_(Одинцовские г.о.)'
-    # target_dir = './data/10_ручей_без_названия_(г.о. Егорьевск)'
-    # target_dir = './data/12_река_Плесенка_(Наро-Фоминский г.о.)'
-    # target_dir = './data/(2023_04_02)/6_река_Вьюница_(г.о. Шатура)'
-    # target_dir = './data/(2023_04_02)/13_река_Шатуха_(Наро-Фоминский г.о., Рузский г.о.)'
-    # target_dir = './data/(2023_04_02)/16_река_Сумерь_(г.о. Пушкинский, Сергиево-Посадский г.о.)'
-    # target_dir = './data/(2023_04_02)/26_река_Нахавня_(Одинцовские г.о.)'
-    # target_dir = './data/(2023_04_02)/33_река_Малые_Вяземы_(Одинцовский г.о.)'
-    # target_dir = './data/(2023_04_02)/34_ручей_без_названия_(г.о. Домодедово)'
-    # target_dir = './data/(2023_04_02)/37_ручей_без_названия_(г.о. Домодедово)'
-    # target_dir = './data/(2023_04_02)/42_река_Беляна_(Одинцовский г.о., г.о. Истра)'
-    # target_dir = './data/(2023_04_02)/44_река_Жданка_(Раменский г.о., г.о. Домодедово)'
-    # target_dir = './data/(2023_04_02)/46_река_Лубянка_(г.о. Ступино)'
-    # target_dir = './data/(2023_04_02)/49_река_Камариха_(г.о. Пушкинский, Дмитровский г.о.)'
-    # target_dir = './data/(2023_04_02)/50_река_Вырка_(Орехово-Зуевский г.о.)'
-
-    # target_dir ='./data/Проекты распоряжений'
-    # target_dir ='./data/Проекты распоряжений/Лотошинский район/299 река Черная test'
-    target_dir ='./data/Проекты распоряжений/Рузский район'
-    # target_dir ='./data/Проекты распоряжений/Лотошинский район/299 река Черная'
-    # target_dir ='./data/Проекты распоряжений/Лотошинский район/865 река Безымянная'
-
-    # filenames = [
-    #     'Приложение 1.xlsx',
-    #     'Приложение 2.xlsx',
-    #     'Приложение 3.xlsx',
-    #     'content.txt'
-    # ]
-
-    filenames = [
-        'каталог координат БЛ.xlsx',
-        'каталог координат ВОЗ.xlsx',
-        'каталог координат ПЗП.xlsx',
-        'content.txt'
-    ]
-    filenames.sort()
+    parser = ArgumentParser(
+        description='Build Directive.docx and coordinate exports for every '
+        'waterbody directory under the target paths.')
+    parser.add_argument(
+        'targets', nargs='*', default=[DEFAULT_TARGET_DIR],
+        help='directories to scan for waterbodies')
+    parser.add_argument(
+        '--layout', choices=sorted(LAYOUTS), default='catalog',
+        help='expected files: "каталог координат *.xlsx" or "Приложение N.xlsx"')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of waterbodies processed in parallel')
+    parser.add_argument(
+        '--timeout', type=float,
+        help='seconds after which a waterbody is abandoned as failed')
+    parser.add_argument(
+        '--journal',
+        help='progress journal, one JSON line per finished waterbody')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='skip waterbodies the journal already has as done')
+    parser.add_argument(
+        '--report',
+        help='write a JSON report with the status of every waterbody')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='rebuild waterbodies even if their inputs have not changed')
+    parser.add_argument(
+        '--scan-only', action='store_true',
+        help='only list waterbodies and which of them are out of date, '
+        'without loading openpyxl, NumPy or python-docx')
+    parser.add_argument(
+        '--scan-threads', type=int, default=8,
+        help='number of threads scanning the directory tree')
+    parser.add_argument(
+        '--index', dest='index_file',
+        help='file to keep the directory index in between runs')
+    parser.add_argument(
+        '--pipeline', dest='pipeline_depth', type=int, nargs='?', const=2,
+        default=0, metavar='DEPTH',
+        help='overlap reading, building and saving of waterbodies with '
+        'queues of DEPTH items between the stages')
+    parser.add_argument(
+        '--export', nargs='+', choices=EXPORT_FORMATS, default=['tsv'],
+        help='coordinate exports: tab-separated .txt, .csv with dot decimals, '
+        'or .bin records of little-endian int64 id and float64 x, y')
+    parser.add_argument(
+        '--documents', nargs='+', choices=DOCUMENT_FORMATS, default=['docx'],
+        help='document formats rendered from the same directive model; '
+        'pdf and odt are written without an office suite')
+    parser.add_argument(
+        '--consolidate', nargs='?', const=CONSOLIDATED_NAME, metavar='NAME',
+        help='append the directives of all waterbodies under a target into '
+        f'one NAME.docx in the target directory (default {CONSOLIDATED_NAME}) '
+        'instead of a Directive.docx per waterbody')
+    parser.add_argument(
+        '--volume-size', type=float, metavar='MB',
+        help='with --consolidate, start a new numbered volume once one '
+        'reaches MB megabytes')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running and rebuild waterbodies as their files change')
+    parser.add_argument(
+        '--debounce', type=float, default=DEBOUNCE, metavar='SECONDS',
+        help='with --watch, wait until a waterbody has not changed for '
+        'SECONDS before rebuilding it')
+    parser.add_argument(
+        '--poll', type=float, metavar='SECONDS',
+        help='with --watch, look for changes every SECONDS instead of '
+        'using inotify')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.0, metavar='DISTANCE',
+        help='treat appendices 2 and 3 as one appendix if their x and y '
+        'differ by at most DISTANCE; changing it rebuilds every waterbody')
+    parser.add_argument(
+        '--cache-dir',
+        help='keep parsed coordinate catalogs in this directory')
+    parser.add_argument(
+        '--cache-size', type=float, default=DEFAULT_CACHE_SIZE / (1 << 20),
+        help='size limit of the coordinate cache in megabytes')
+    parser.add_argument(
+        '--stream-rows', type=int, default=STREAM_ROWS, metavar='ROWS',
+        help='stream appendix tables of at least ROWS points straight into '
+        'the saved document instead of building them in memory; '
+        '0 streams every table')
+    parser.add_argument(
+        '--compress-level', type=int, choices=range(10),
+        default=DEFAULT_COMPRESS_LEVEL, metavar='LEVEL',
+        help='deflate level of saved documents from 1 (fastest) to 9 '
+        f'(smallest), 0 stores them uncompressed (default {DEFAULT_COMPRESS_LEVEL})')
+    parser.add_argument(
+        '--save-threads', type=int, metavar='N',
+        help='threads serializing and compressing the parts of a docx '
+        f'(default {SAVE_THREADS})')
+    parser.add_argument(
+        '--reuse', choices=REUSE_MODES, default='link',
+        help='parse, format and export identical catalogs once per process '
+        'and hard link or copy their exports; "off" handles every catalog '
+        'on its own')
+    parser.add_argument(
+        '--profile', metavar='REPORT',
+        help='record stage timings into a .json or .csv report')
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help='also record peak memory of every stage (slower)')
+    args = parser.parse_args()
+
+    if args.resume and not args.journal:
+        parser.error('--resume needs --journal')
+    if args.volume_size is not None and args.consolidate is None:
+        parser.error('--volume-size needs --consolidate')
+    if args.consolidate is not None:
+        # Volumes are written in directory order by a single process.
+        if args.jobs > 1 or args.timeout or args.pipeline_depth or args.resume:
+            parser.error(
+                '--consolidate does not combine with -j, --timeout, '
+                '--pipeline or --resume')
+        if args.documents != ['docx']:
+            parser.error('consolidated volumes are written as docx only')
+        if args.save_threads is not None:
+            # Volumes are streamed directive by directive in one thread.
+            parser.error('--save-threads does not apply to --consolidate')
+        args.documents = []
+    if args.watch and (
+            args.consolidate is not None or args.scan_only or args.timeout or
+            args.pipeline_depth or args.resume or args.report):
+        parser.error(
+            '--watch does not combine with --consolidate, --scan-only, '
+            '--timeout, --pipeline, --resume or --report')
+    volume_size = None
+    if args.volume_size is not None:
+        volume_size = int(args.volume_size * (1 << 20))
+    if args.profile:
+        instrumentation.enable(memory=args.profile_memory)
+    if args.save_threads is None:
+        args.save_threads = SAVE_THREADS
+    save_options = {
+        'compress_level': args.compress_level, 'threads': args.save_threads}
+
+    filenames = sorted(LAYOUTS[args.layout])
+    if args.scan_only:
+        for target in args.targets:
+            scan_waterbodies(
+                filenames, target, args.scan_threads, args.index_file,
+                args.force, args.export, args.documents, args.tolerance)
+        sys.exit(0)
+
+    journal = Journal(args.journal, args.resume) if args.journal else None
+    if args.watch:
+        watch_directories(
+            filenames, args.targets, jobs=args.jobs,
+            scan_threads=args.scan_threads, index_file=args.index_file,
+            export_formats=args.export, cache_dir=args.cache_dir,
+            cache_size=int(args.cache_size * (1 << 20)), journal=journal,
+            stream_rows=args.stream_rows, reuse=args.reuse,
+            document_formats=args.documents, debounce=args.debounce,
+            poll_interval=args.poll, save_options=save_options,
+            tolerance=args.tolerance)
+        if args.profile:
+            instrumentation.print_summary()
+            instrumentation.write_report(args.profile)
+        sys.exit(0)
+    started = datetime.now().isoformat(timespec='seconds')
+    results = []
+    for target in args.targets:
+        results += process_directory(
+            filenames, _path=target, jobs=args.jobs, force=args.force,
+            scan_threads=args.scan_threads, index_file=args.index_file,
+            export_formats=args.export, pipeline_depth=args.pipeline_depth,
+            cache_dir=args.cache_dir,
+            cache_size=int(args.cache_size * (1 << 20)),
+            timeout=args.timeout, journal=journal,
+            stream_rows=args.stream_rows, reuse=args.reuse,
+            document_formats=args.documents, consolidate=args.consolidate,
+            volume_size=volume_size, save_options=save_options,
+            tolerance=args.tolerance)
 
-    process_directory(filenames, _path=target_dir)
-    
\ No newline at end of file
+    catalogs = validation.drain_catalogs()
+    validation.print_findings(catalogs)
+    if args.profile:
+        instrumentation.print_summary()
+        instrumentation.write_report(args.profile)
+    if args.report:
+        write_run_report(
+            args.report, results, started=started,
+            targets=[abspath(t) for t in args.targets], layout=args.layout,
+            catalogs=catalogs)
+    if any(s == 'failed' for d, s, e in results):
+        sys.exit(1)
@@ -0,0 +1,170 @@
+import csv
+import json
+import threading
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+from math import ceil
+from os.path import splitext
+from time import perf_counter, process_time
+
+METRICS = ['wall_ms', 'cpu_ms', 'peak_kb']
+
+
+class _State:
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.samples = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+_state = _State()
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.peak = 0
+
+    def _stack(self):
+        stack = getattr(_state.local, 'stack', None)
+        if stack is None:
+            stack = _state.local.stack = []
+        return stack
+
+    def __enter__(self):
+        stack = self._stack()
+        if _state.memory:
+            # tracemalloc has a single peak counter, so it is folded into
+            # the enclosing span before being reset for this one.
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        stack.append(self)
+        self.cpu_start = process_time()
+        self.wall_start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = perf_counter() - self.wall_start
+        cpu = process_time() - self.cpu_start
+        stack = self._stack()
+        stack.pop()
+        peak_kb = None
+        if _state.memory:
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            peak_kb = max(0, peak - self.memory_start) / 1024
+        record(self.stage, wall * 1e3, cpu * 1e3, peak_kb)
+        return False
+
+
+def enable(memory=False):
+    _state.enabled = True
+    _state.memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    _state.enabled = False
+    if _state.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state.memory = False
+
+def is_enabled():
+    return _state.enabled
+
+def settings():
+    return {'memory': _state.memory} if _state.enabled else None
+
+def record(stage, wall_ms, cpu_ms, peak_kb=None):
+    with _state.lock:
+        _state.samples.append((stage, wall_ms, cpu_ms, peak_kb))
+
+def span(stage):
+    if not _state.enabled:
+        return _NULL_SPAN
+    return _Span(stage)
+
+def timeit(stage):
+    def decorator(method):
+        @wraps(method)
+        def wrapped(*args, **kwargs):
+            if not _state.enabled:
+                return method(*args, **kwargs)
+            with _Span(stage):
+                return method(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def drain_samples():
+    with _state.lock:
+        samples = _state.samples
+        _state.samples = []
+    return samples
+
+def merge_samples(samples):
+    with _state.lock:
+        _state.samples.extend(samples)
+
+def _percentile(values, q):
+    values = sorted(values)
+    index = max(0, ceil(q * len(values)) - 1)
+    return values[index]
+
+def summarize(samples=None):
+    if samples is None:
+        samples = _state.samples
+    stages = {}
+    for stage, *values in samples:
+        stages.setdefault(stage, []).append(values)
+    result = []
+    for stage, rows in stages.items():
+        summary = {'stage': stage, 'count': len(rows)}
+        for i, metric in enumerate(METRICS):
+            values = [row[i] for row in rows if row[i] is not None]
+            if not values:
+                continue
+            summary[f'{metric}_total'] = sum(values)
+            summary[f'{metric}_p50'] = _percentile(values, 0.5)
+            summary[f'{metric}_p95'] = _percentile(values, 0.95)
+            summary[f'{metric}_max'] = max(values)
+        result.append(summary)
+    result.sort(key=lambda s: s.get('wall_ms_total', 0), reverse=True)
+    return result
+
+def write_report(_path, summary=None):
+    if summary is None:
+        summary = summarize()
+    try:
+        with open(_path, 'w', encoding='utf-8', newline='') as f:
+            if splitext(_path)[1].lower() == '.csv':
+                fields = ['stage', 'count'] + [
+                    f'{m}_{a}' for m in METRICS
+                    for a in ['total', 'p50', 'p95', 'max']]
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(summary)
+            else:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+    except IOError:
+        print(f'I/O error with <{_path}>.')
+
+def print_summary(summary=None):
+    if summary is None:
+        summary = summarize()
+    for s in summary:
+        print(
+            f"{s['stage']:>20}: {s['count']:>5} calls, "
+            f"total {s['wall_ms_total']:.1f} ms, "
+            f"p50 {s['wall_ms_p50']:.2f} ms, p95 {s['wall_ms_p95']:.2f} ms, "
+            f"max {s['wall_ms_max']:.2f} ms")
@@ -0,0 +1,62 @@
+import json
+from hashlib import sha256
+from os.path import basename, exists, join, splitext
+
+GENERATOR_VERSION = '1'
+MANIFEST_FILENAME = '.directive_manifest.json'
+DIRECTIVE_NAME = 'Directive'
+EXPORT_EXTENSIONS = {'tsv': 'txt', 'csv': 'csv', 'bin': 'bin'}
+
+def hash_files(paths, seed=GENERATOR_VERSION, file_digests=None):
+    # With file_digests, the digest of every file's own content is filled in
+    # from the same read, so catalogs are not read again to key the memo
+    # and the coordinate cache.
+    h = sha256(seed.encode('utf-8'))
+    for p in paths:
+        h.update(basename(p).encode('utf-8'))
+        file_hash = sha256()
+        with open(p, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+                file_hash.update(chunk)
+        if file_digests is not None:
+            file_digests[basename(p)] = file_hash.hexdigest()
+    return h.hexdigest()
+
+def output_files(filenames, export_formats=('tsv',), document_formats=('docx',)):
+    extensions = [EXPORT_EXTENSIONS[f] for f in export_formats]
+    result = [f'{DIRECTIVE_NAME}.{f}' for f in document_formats]
+    for f in filenames:
+        name, ext = splitext(f)
+        if ext == '.xlsx':
+            result += [f'{name}.{e}' for e in extensions]
+    return result
+
+def read_manifest(directory):
+    try:
+        with open(join(directory, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_manifest(directory, digest, outputs):
+    manifest = {
+        'generator_version': GENERATOR_VERSION,
+        'hash': digest,
+        'outputs': outputs
+    }
+    try:
+        with open(join(directory, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    except IOError:
+        print(f'I/O error with <{join(directory, MANIFEST_FILENAME)}>.')
+
+def is_up_to_date(directory, digest, outputs):
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get('hash') != digest:
+        return False
+    # Outputs the manifest does not list were left by a run with other
+    # inputs, or never written at all.
+    if not set(outputs) <= set(manifest.get('outputs', [])):
+        return False
+    return all(exists(join(directory, f)) for f in outputs)
@@ -0,0 +1,302 @@
+import re
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from instrumentation import timeit
+from render import write_output
+from styles import (
+    CM, FONT_NAME, HIGHLIGHTS, PAGE, STYLES, TABLE_COLUMNS, table_head)
+from zipwriter import DEFAULT_COMPRESS_LEVEL
+
+MIMETYPE = 'application/vnd.oasis.opendocument.text'
+CHUNK_ROWS = 1000
+
+_NAMESPACES = ' '.join([
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"',
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0"',
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"',
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"',
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0"',
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0"',
+    'xmlns:meta="urn:oasis:names:tc:opendocument:xmlns:meta:1.0"',
+])
+_ALIGNMENTS = {
+    'justify': 'justify', 'center': 'center', 'left': 'start', 'right': 'end'}
+_SPACES = re.compile('  +')
+
+
+def _pt(value):
+    return f'{value:.2f}pt'
+
+def _style_name(name):
+    return name.replace(' ', '_20_')
+
+def _text_xml(text):
+    text = escape(text)
+    text = _SPACES.sub(
+        lambda m: f' <text:s text:c="{len(m.group()) - 1}"/>', text)
+    if text.startswith(' '):
+        text = '<text:s/>' + text[1:]
+    return text.replace('\n', '<text:line-break/>').replace('\t', '<text:tab/>')
+
+def _paragraph_xml(style_name, runs):
+    parts = []
+    for text, flag in runs:
+        xml = _text_xml(text)
+        if flag in HIGHLIGHTS:
+            xml = f'<text:span text:style-name="Highlight{flag}">{xml}</text:span>'
+        parts.append(xml)
+    return f'<text:p text:style-name="{style_name}">{"".join(parts)}</text:p>'
+
+def _paragraph_style_xml(name, style):
+    properties = [
+        f'fo:text-align="{_ALIGNMENTS[style["align"]]}"',
+        f'fo:text-indent="{_pt(style["first_indent"])}"',
+        f'fo:margin-left="{_pt(style["left_indent"])}"',
+        f'fo:margin-top="{_pt(style["space_before"])}"',
+        f'fo:margin-bottom="{_pt(style["space_after"])}"',
+        f'fo:line-height="{style["line_spacing"] * 100:.0f}%"',
+    ]
+    if style['align'] == 'justify':
+        properties.append('fo:text-align-last="start"')
+    weight = 'bold' if style['bold'] else 'normal'
+    return (
+        f'<style:style style:name="{_style_name(name)}" '
+        f'style:display-name={quoteattr(name)} style:family="paragraph" '
+        'style:parent-style-name="Standard">'
+        f'<style:paragraph-properties {" ".join(properties)}/>'
+        f'<style:text-properties fo:font-size="{_pt(style["size"])}" '
+        f'fo:font-weight="{weight}" style:font-weight-complex="{weight}"/>'
+        '</style:style>')
+
+def _styles_xml():
+    body = PAGE['top'] - PAGE['header']
+    header_line = PAGE['header_size'] * 1.15
+    page = (
+        f'fo:page-width="{_pt(PAGE["width"])}" '
+        f'fo:page-height="{_pt(PAGE["height"])}" '
+        f'fo:margin-left="{_pt(PAGE["left"])}" '
+        f'fo:margin-right="{_pt(PAGE["right"])}" '
+        f'fo:margin-bottom="{_pt(PAGE["bottom"])}" '
+        'style:print-orientation="portrait"')
+    highlights = ''.join(
+        f'<style:style style:name="Highlight{flag}" style:family="text">'
+        f'<style:text-properties fo:background-color="#{color}"/></style:style>'
+        for flag, color in HIGHLIGHTS.items())
+    paragraph_styles = ''.join(
+        _paragraph_style_xml(name, style) for name, style in STYLES.items())
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<office:document-styles {_NAMESPACES} office:version="1.2">'
+        '<office:font-face-decls>'
+        f'<style:font-face style:name="{FONT_NAME}" '
+        f'svg:font-family="&apos;{FONT_NAME}&apos;" '
+        'style:font-family-generic="roman" style:font-pitch="variable"/>'
+        '</office:font-face-decls>'
+        '<office:styles>'
+        '<style:default-style style:family="paragraph">'
+        f'<style:text-properties style:font-name="{FONT_NAME}" '
+        'fo:font-size="14pt" fo:language="ru" fo:country="RU"/>'
+        '</style:default-style>'
+        '<style:style style:name="Standard" style:family="paragraph" '
+        'style:class="text"/>'
+        '<style:style style:name="Header" style:family="paragraph" '
+        'style:parent-style-name="Standard" style:class="extra">'
+        '<style:paragraph-properties fo:text-align="center"/>'
+        f'<style:text-properties fo:font-size="{_pt(PAGE["header_size"])}"/>'
+        '</style:style>'
+        f'{paragraph_styles}{highlights}'
+        '</office:styles>'
+        '<office:automatic-styles>'
+        '<style:page-layout style:name="HeaderLayout">'
+        f'<style:page-layout-properties {page} '
+        f'fo:margin-top="{_pt(PAGE["header"])}"/>'
+        '<style:header-style><style:header-footer-properties '
+        f'fo:min-height="0pt" '
+        f'fo:margin-bottom="{_pt(max(0, body - header_line))}"/>'
+        '</style:header-style>'
+        '</style:page-layout>'
+        '<style:page-layout style:name="FirstLayout">'
+        f'<style:page-layout-properties {page} '
+        f'fo:margin-top="{_pt(PAGE["top"])}"/>'
+        '</style:page-layout>'
+        '</office:automatic-styles>'
+        '<office:master-styles>'
+        '<style:master-page style:name="Standard" '
+        'style:page-layout-name="HeaderLayout">'
+        '<style:header><text:p text:style-name="Header">'
+        '<text:page-number text:select-page="current"/>'
+        '</text:p></style:header>'
+        '</style:master-page>'
+        '<style:master-page style:name="First" '
+        'style:page-layout-name="FirstLayout" style:next-style-name="Standard"/>'
+        '</office:master-styles>'
+        '</office:document-styles>')
+
+def _automatic_styles_xml():
+    # Every part starts on a page without a header and numbers its pages
+    # from 1, as the docx sections do.
+    text_width = PAGE['width'] - PAGE['left'] - PAGE['right']
+    column_width = (text_width - PAGE['column_gap']) / 2
+    styles = []
+    for name, style in STYLES.items():
+        styles.append(
+            f'<style:style style:name="Start_{_style_name(name)}" '
+            'style:family="paragraph" '
+            f'style:parent-style-name="{_style_name(name)}" '
+            'style:master-page-name="First">'
+            '<style:paragraph-properties style:page-number="1"/>'
+            '</style:style>')
+        styles.append(
+            f'<style:style style:name="Break_{_style_name(name)}" '
+            'style:family="paragraph" '
+            f'style:parent-style-name="{_style_name(name)}">'
+            '<style:paragraph-properties fo:break-before="page"/>'
+            '</style:style>')
+    styles += [
+        '<style:style style:name="Columns" style:family="section">'
+        '<style:section-properties>'
+        f'<style:columns fo:column-count="2" fo:column-gap="{_pt(PAGE["column_gap"])}"/>'
+        '</style:section-properties></style:style>',
+        '<style:style style:name="CoordinateTable" style:family="table">'
+        f'<style:table-properties style:width="{_pt(column_width)}" '
+        'table:align="margins"/></style:style>',
+        '<style:style style:name="SignatureTable" style:family="table">'
+        f'<style:table-properties style:width="{_pt(text_width)}" '
+        'table:align="margins"/></style:style>',
+        '<style:style style:name="SignatureColumn" style:family="table-column">'
+        f'<style:table-column-properties style:column-width="{_pt(text_width / 2)}"/>'
+        '</style:style>',
+        '<style:style style:name="HeadRow" style:family="table-row">'
+        f'<style:table-row-properties style:min-row-height="{_pt(1.96 * CM)}"/>'
+        '</style:style>',
+        '<style:style style:name="Cell" style:family="table-cell">'
+        '<style:table-cell-properties fo:border="0.5pt solid #000000" '
+        'fo:padding="1.4pt" style:vertical-align="middle"/></style:style>',
+        '<style:style style:name="SignatureCell" style:family="table-cell">'
+        '<style:table-cell-properties fo:border="none" fo:padding="0pt" '
+        'style:vertical-align="bottom"/></style:style>',
+    ]
+    for i, share in enumerate(TABLE_COLUMNS):
+        styles.append(
+            f'<style:style style:name="Column{i}" style:family="table-column">'
+            '<style:table-column-properties '
+            f'style:column-width="{_pt(column_width * share)}"/></style:style>')
+    return f'<office:automatic-styles>{"".join(styles)}</office:automatic-styles>'
+
+def _cell_xml(text, style='Table_20_Text', span=''):
+    return (
+        f'<table:table-cell table:style-name="Cell"{span} '
+        'office:value-type="string">'
+        f'<text:p text:style-name="{style}">{_text_xml(text)}</text:p>'
+        '</table:table-cell>')
+
+def _iter_table_xml(block, number):
+    head = table_head(block['title'])
+    heading = 'Table_20_Heading'
+    yield (
+        f'<text:section text:style-name="Columns" text:name="Coordinates{number}">'
+        f'<table:table table:name="Coordinates{number}" '
+        'table:style-name="CoordinateTable">'
+        + ''.join(
+            f'<table:table-column table:style-name="Column{i}"/>'
+            for i in range(len(TABLE_COLUMNS)))
+        + '<table:table-row table:style-name="HeadRow">'
+        + _cell_xml(head[0], heading, ' table:number-rows-spanned="2"')
+        + _cell_xml(head[1], heading, ' table:number-columns-spanned="2"')
+        + '<table:covered-table-cell/></table:table-row>'
+        + '<table:table-row><table:covered-table-cell/>'
+        + _cell_xml(head[2], heading) + _cell_xml(head[3], heading)
+        + '</table:table-row><table:table-row>'
+        + ''.join(_cell_xml(t, heading) for t in head[4:])
+        + '</table:table-row>')
+    data = block['rows']
+    for start in range(0, len(data), CHUNK_ROWS):
+        chunk = data[start:start + CHUNK_ROWS]
+        if hasattr(chunk, 'tolist'):
+            chunk = chunk.tolist()
+        yield ''.join(
+            '<table:table-row>' + ''.join(_cell_xml(t) for t in row)
+            + '</table:table-row>' for row in chunk)
+    yield '</table:table></text:section>'
+
+def _signature_xml(block, prefix):
+    cells = ''.join(
+        '<table:table-cell table:style-name="SignatureCell" '
+        'office:value-type="string">'
+        + _paragraph_xml(f'{prefix}{_style_name(s)}', [(t, 0)])
+        + '</table:table-cell>'
+        for t, s in zip(block['cells'], block['styles']))
+    return (
+        '<table:table table:name="Signature" table:style-name="SignatureTable">'
+        '<table:table-column table:style-name="SignatureColumn" '
+        'table:number-columns-repeated="2"/>'
+        f'<table:table-row>{cells}</table:table-row></table:table>')
+
+def iter_content_xml(model):
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<office:document-content {_NAMESPACES} office:version="1.2">'
+        + _automatic_styles_xml()
+        + '<office:body><office:text>')
+    # A part break (new section) or page break applies to whatever comes
+    # next, so consecutive breaks never leave a blank page.
+    pending = 'Start_'
+    tables = 0
+    for block in model['blocks']:
+        kind = block['type']
+        if kind == 'section':
+            pending = 'Start_'
+        elif kind == 'page_break':
+            pending = pending or 'Break_'
+        elif kind == 'paragraph':
+            yield _paragraph_xml(
+                f'{pending}{_style_name(block["style"])}', block['runs'])
+            pending = ''
+        elif kind == 'signature':
+            yield _signature_xml(block, pending)
+            pending = ''
+        elif kind == 'table':
+            if pending:
+                yield f'<text:p text:style-name="{pending}Table_20_Text"/>'
+            tables += 1
+            yield from _iter_table_xml(block, tables)
+            pending = 'Break_'
+    yield '</office:text></office:body></office:document-content>'
+
+def _manifest_xml():
+    entries = ''.join(
+        f'<manifest:file-entry manifest:full-path="{p}" '
+        f'manifest:media-type="{t}"/>'
+        for p, t in [
+            ('/', MIMETYPE), ('content.xml', 'text/xml'),
+            ('styles.xml', 'text/xml'), ('meta.xml', 'text/xml')])
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<manifest:manifest xmlns:manifest='
+        '"urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+        f'manifest:version="1.2">{entries}</manifest:manifest>')
+
+def _meta_xml():
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<office:document-meta {_NAMESPACES} office:version="1.2">'
+        '<office:meta><meta:generator>ex_to_word</meta:generator></office:meta>'
+        '</office:document-meta>')
+
+@timeit('save_odt')
+def write_odt(model, target, compress_level=DEFAULT_COMPRESS_LEVEL):
+    write_output(target, lambda f: _write_odt(model, f, compress_level))
+
+def _write_odt(model, f, compress_level):
+    # Level 0 stores every entry, as the docx writer does.
+    compression = ZIP_DEFLATED if compress_level else ZIP_STORED
+    with ZipFile(f, 'w', compression, compresslevel=compress_level) as odt:
+        # The mimetype entry must come first and stay uncompressed.
+        odt.writestr('mimetype', MIMETYPE, compress_type=ZIP_STORED)
+        odt.writestr('META-INF/manifest.xml', _manifest_xml())
+        odt.writestr('meta.xml', _meta_xml())
+        odt.writestr('styles.xml', _styles_xml())
+        with odt.open('content.xml', 'w') as content:
+            for xml in iter_content_xml(model):
+                content.write(xml.encode('utf-8'))
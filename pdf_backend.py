@@ -0,0 +1,543 @@
+import re
+import threading
+import zlib
+from os.path import basename, exists, splitext
+
+from instrumentation import timeit
+from render import write_output
+from styles import CM, HIGHLIGHTS, PAGE, STYLES, TABLE_COLUMNS, table_head
+from truetype import TrueTypeFont
+from zipwriter import DEFAULT_COMPRESS_LEVEL
+
+# Regular and bold faces tried in order. Times New Roman is what the docx
+# asks for, Liberation Serif has the same metrics, DejaVu Serif is the
+# last resort. Without a bold face bold text is drawn with a thin outline.
+FONT_CANDIDATES = [
+    ('C:/Windows/Fonts/times.ttf', 'C:/Windows/Fonts/timesbd.ttf'),
+    ('/Library/Fonts/Times New Roman.ttf',
+        '/Library/Fonts/Times New Roman Bold.ttf'),
+    ('/System/Library/Fonts/Supplemental/Times New Roman.ttf',
+        '/System/Library/Fonts/Supplemental/Times New Roman Bold.ttf'),
+    ('/usr/share/fonts/truetype/msttcorefonts/Times_New_Roman.ttf',
+        '/usr/share/fonts/truetype/msttcorefonts/Times_New_Roman_Bold.ttf'),
+    ('/usr/share/fonts/truetype/liberation/LiberationSerif-Regular.ttf',
+        '/usr/share/fonts/truetype/liberation/LiberationSerif-Bold.ttf'),
+    ('/usr/share/fonts/liberation-serif/LiberationSerif-Regular.ttf',
+        '/usr/share/fonts/liberation-serif/LiberationSerif-Bold.ttf'),
+    ('/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf',
+        '/usr/share/fonts/truetype/dejavu/DejaVuSerif-Bold.ttf'),
+    ('/usr/share/fonts/dejavu/DejaVuSerif.ttf',
+        '/usr/share/fonts/dejavu/DejaVuSerif-Bold.ttf'),
+]
+CELL_PADDING = 0.19 * CM
+CHUNK_ROWS = 1000
+
+_fonts = None
+_fonts_lock = threading.Lock()
+_BREAKS = re.compile('( |\n)')
+
+
+def load_fonts():
+    # Parsed once per process and shared by every document.
+    global _fonts
+    with _fonts_lock:
+        if _fonts is None:
+            for regular, bold in FONT_CANDIDATES:
+                if exists(regular):
+                    _fonts = (
+                        TrueTypeFont(regular),
+                        TrueTypeFont(bold) if exists(bold) else None)
+                    break
+            else:
+                raise FileNotFoundError(
+                    'No TrueType serif font for PDF output, looked for '
+                    + ', '.join(r for r, b in FONT_CANDIDATES))
+    return _fonts
+
+
+class _Face:
+
+    def __init__(self, font, resource):
+        self.font = font
+        self.resource = resource
+        self.scale = 1 / font.units_per_em
+        self.ascent = font.ascent * self.scale
+        self.descent = font.descent * self.scale
+        self.line_height = (
+            font.ascent - font.descent + font.line_gap) * self.scale
+        self._glyphs = {}
+        self._widths = {}
+        self.used = {}
+
+    def _glyph(self, ch):
+        gid = self._glyphs.get(ch)
+        if gid is None:
+            gid = self.font.cmap.get(ord(ch))
+            if gid is None:
+                gid = self.font.cmap.get(32, 0) if ch.isspace() else 0
+            self._glyphs[ch] = gid
+            self._widths[ch] = self.font.advances[gid] * self.scale
+        return gid
+
+    def width(self, text, size):
+        widths = self._widths
+        total = 0
+        for ch in text:
+            if ch not in widths:
+                self._glyph(ch)
+            total += widths[ch]
+        return total * size
+
+    def encode(self, text):
+        result = []
+        for ch in text:
+            gid = self._glyph(ch)
+            self.used[gid] = ch
+            result.append(f'{gid:04X}')
+        return ''.join(result)
+
+
+def _words(runs):
+    # Words are lists of (text, flag) fragments, None stands for a line
+    # break. Non-breaking spaces stay inside their word.
+    words = []
+    current = []
+    for text, flag in runs:
+        for part in _BREAKS.split(text.replace('\t', ' ')):
+            if part == ' ' or part == '\n':
+                if current:
+                    words.append(current)
+                    current = []
+                if part == '\n':
+                    words.append(None)
+            elif part:
+                current.append((part, flag))
+    if current:
+        words.append(current)
+    return words
+
+
+class _Writer:
+
+    def __init__(self, f, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.f = f
+        self.compress_level = compress_level
+        self.offsets = {}
+        self.next_id = 1
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def reserve(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def write_object(self, object_id, body):
+        self.offsets[object_id] = self.f.tell()
+        self.f.write(f'{object_id} 0 obj\n{body}\nendobj\n'.encode('latin-1'))
+
+    def write_stream(self, object_id, data, entries=''):
+        data = zlib.compress(data, self.compress_level)
+        self.offsets[object_id] = self.f.tell()
+        self.f.write(
+            f'{object_id} 0 obj\n<< /Length {len(data)} /Filter /FlateDecode'
+            f'{entries} >>\nstream\n'.encode('latin-1'))
+        self.f.write(data)
+        self.f.write(b'\nendstream\nendobj\n')
+
+    def finish(self, root_id, info_id):
+        xref = self.f.tell()
+        lines = [f'xref\n0 {self.next_id}\n', '0000000000 65535 f \n']
+        for object_id in range(1, self.next_id):
+            lines.append(f'{self.offsets[object_id]:010d} 00000 n \n')
+        lines.append(
+            f'trailer\n<< /Size {self.next_id} /Root {root_id} 0 R '
+            f'/Info {info_id} 0 R >>\nstartxref\n{xref}\n%%EOF\n')
+        self.f.write(''.join(lines).encode('latin-1'))
+
+
+class _PdfDocument:
+
+    def __init__(self, writer):
+        regular, bold = load_fonts()
+        self.writer = writer
+        self.faces = [_Face(regular, 'F1')]
+        if bold is not None:
+            self.faces.append(_Face(bold, 'F2'))
+        self.pages_id = writer.reserve()
+        self.resources_id = writer.reserve()
+        self.page_ids = []
+        self.text_width = PAGE['width'] - PAGE['left'] - PAGE['right']
+        self.ops = None
+        self.part_page = 0
+        self.pending = 'part'
+        self.overflowed = False
+        self.y = 0
+
+    def face(self, bold):
+        return self.faces[-1] if bold else self.faces[0]
+
+    def fake_bold(self, bold):
+        return bold and len(self.faces) == 1
+
+    # Pages
+
+    def start_page(self, new_part=False, overflow=False):
+        self.finish_page()
+        self.part_page = 1 if new_part else self.part_page + 1
+        self.ops = ['0 0 0 RG 0.5 w']
+        self.y = PAGE['height'] - PAGE['top']
+        self.overflowed = overflow
+
+    def finish_page(self):
+        if self.ops is None:
+            return
+        if self.part_page > 1:
+            # As in the docx, the first page of every part has no number.
+            size = PAGE['header_size']
+            face = self.face(False)
+            number = str(self.part_page)
+            x = PAGE['left'] + (self.text_width - face.width(number, size)) / 2
+            y = PAGE['height'] - PAGE['header'] - face.ascent * size
+            self.ops.append(self.text_op(face, size, x, y, number))
+        content_id = self.writer.reserve()
+        page_id = self.writer.reserve()
+        self.writer.write_stream(content_id, '\n'.join(self.ops).encode('latin-1'))
+        self.writer.write_object(
+            page_id,
+            f'<< /Type /Page /Parent {self.pages_id} 0 R '
+            f'/MediaBox [0 0 {PAGE["width"]:.2f} {PAGE["height"]:.2f}] '
+            f'/Resources {self.resources_id} 0 R /Contents {content_id} 0 R >>')
+        self.page_ids.append(page_id)
+        self.ops = None
+
+    def begin_block(self):
+        # Breaks are applied when content follows, so consecutive breaks
+        # never leave a blank page.
+        if self.pending:
+            self.start_page(new_part=self.pending == 'part')
+            self.pending = None
+
+    def fits(self, height):
+        return self.y - height >= PAGE['bottom']
+
+    # Text
+
+    def text_op(self, face, size, x, y, text, bold=False):
+        encoded = face.encode(text)
+        if self.fake_bold(bold):
+            return (
+                f'q {size * 0.03:.2f} w BT /{face.resource} {size:g} Tf 2 Tr '
+                f'1 0 0 1 {x:.2f} {y:.2f} Tm <{encoded}> Tj ET Q')
+        return (
+            f'BT /{face.resource} {size:g} Tf 1 0 0 1 {x:.2f} {y:.2f} Tm '
+            f'<{encoded}> Tj ET')
+
+    def line_height(self, style):
+        return self.face(style['bold']).line_height * style['size'] * style['line_spacing']
+
+    def lay_out(self, runs, style, width):
+        size = style['size']
+        face = self.face(style['bold'])
+        space = face.width(' ', size)
+        height = self.line_height(style)
+        lines = []
+        line = []
+        natural = 0
+
+        def available():
+            indent = style['left_indent']
+            if not lines:
+                indent += style['first_indent']
+            return indent, width - indent
+
+        def finish(last):
+            indent, room = available()
+            gap = space
+            x = indent
+            if style['align'] == 'center':
+                x += (room - natural) / 2
+            elif style['align'] == 'right':
+                x += room - natural
+            elif style['align'] == 'justify' and not last and len(line) > 1:
+                gap += (room - natural) / (len(line) - 1)
+            items = []
+            for word, word_width in line:
+                for text, flag in word:
+                    text_width = face.width(text, size)
+                    items.append((x, text, flag, text_width))
+                    x += text_width
+                x += gap
+            lines.append({'height': height, 'items': items})
+
+        for word in _words(runs):
+            if word is None:
+                finish(True)
+                line = []
+                natural = 0
+                continue
+            word_width = sum(face.width(t, size) for t, f in word)
+            if line and natural + space + word_width > available()[1]:
+                finish(False)
+                line = []
+                natural = 0
+            while not line and word_width > available()[1] and len(word) == 1 and len(word[0][0]) > 1:
+                # A word wider than the line is broken between characters.
+                text, flag = word[0]
+                room = available()[1]
+                cut = 1
+                while cut < len(text) and face.width(text[:cut + 1], size) <= room:
+                    cut += 1
+                line = [([(text[:cut], flag)], face.width(text[:cut], size))]
+                natural = line[0][1]
+                finish(False)
+                line = []
+                natural = 0
+                word = [(text[cut:], flag)]
+                word_width = face.width(text[cut:], size)
+            natural += (space if line else 0) + word_width
+            line.append((word, word_width))
+        if line or not lines:
+            finish(True)
+        return lines
+
+    def draw_lines(self, lines, style, x, y):
+        size = style['size']
+        face = self.face(style['bold'])
+        for line in lines:
+            baseline = y - face.ascent * size
+            for item_x, text, flag, text_width in line['items']:
+                if flag in HIGHLIGHTS:
+                    color = HIGHLIGHTS[flag]
+                    rgb = ' '.join(
+                        f'{int(color[i:i + 2], 16) / 255:.2f}' for i in (0, 2, 4))
+                    self.ops.append(
+                        f'q {rgb} rg {x + item_x:.2f} {baseline + face.descent * size:.2f} '
+                        f'{text_width:.2f} {(face.ascent - face.descent) * size:.2f} re f Q')
+            for item_x, text, flag, text_width in line['items']:
+                self.ops.append(self.text_op(
+                    face, size, x + item_x, baseline, text, style['bold']))
+            y -= line['height']
+        return y
+
+    # Blocks
+
+    def paragraph(self, block):
+        style = STYLES[block['style']]
+        self.begin_block()
+        lines = self.lay_out(block['runs'], style, self.text_width)
+        if not self.overflowed:
+            self.y -= style['space_before']
+        for line in lines:
+            if not self.fits(line['height']) and not self.overflowed:
+                self.start_page(overflow=True)
+            self.y = self.draw_lines([line], style, PAGE['left'], self.y)
+            self.overflowed = False
+        self.y -= style['space_after']
+
+    def signature(self, block):
+        self.begin_block()
+        width = self.text_width / 2
+        cells = []
+        for i, (text, style_name) in enumerate(zip(block['cells'], block['styles'])):
+            style = STYLES[style_name]
+            lines = self.lay_out([(text, 0)], style, width)
+            cells.append((style, lines, sum(l['height'] for l in lines)))
+        height = max(h for s, l, h in cells)
+        if not self.fits(height) and not self.overflowed:
+            self.start_page(overflow=True)
+        for i, (style, lines, cell_height) in enumerate(cells):
+            self.draw_lines(
+                lines, style, PAGE['left'] + i * width,
+                self.y - (height - cell_height))
+        self.y -= height
+        self.overflowed = False
+
+    def table(self, block):
+        self.begin_block()
+        text_style = STYLES['Table Text']
+        head_style = STYLES['Table Heading']
+        column_width = (self.text_width - PAGE['column_gap']) / 2
+        widths = [column_width * share for share in TABLE_COLUMNS]
+        offsets = [sum(widths[:i]) for i in range(len(widths))]
+        frames = [PAGE['left'], PAGE['left'] + column_width + PAGE['column_gap']]
+        row_height = self.line_height(text_style)
+
+        frame = [0, self.y]
+
+        def place(height):
+            # Rows run down the left column, then the right one, then on to
+            # the next page.
+            if self.fits(height) or self.overflowed:
+                return
+            if frame[0] == 0:
+                frame[0] = 1
+                self.y = frame[1]
+            else:
+                self.start_page(overflow=True)
+                frame[0] = 0
+                frame[1] = self.y
+            self.overflowed = not self.fits(height)
+
+        def cell(text, style, x, top, width, height):
+            lines = self.lay_out([(text, 0)], style, width - 2 * CELL_PADDING)
+            text_height = sum(l['height'] for l in lines)
+            self.ops.append(f'{x:.2f} {top - height:.2f} {width:.2f} {height:.2f} re S')
+            self.draw_lines(
+                lines, style, x + CELL_PADDING,
+                top - max(0, height - text_height) / 2)
+
+        head = table_head(block['title'])
+        first = self.lay_out([(head[0], 0)], head_style, widths[0] - 2 * CELL_PADDING)
+        title = self.lay_out(
+            [(head[1], 0)], head_style, widths[1] + widths[2] - 2 * CELL_PADDING)
+        heights = [
+            max(1.96 * CM, sum(l['height'] for l in title)), row_height, row_height]
+        heights[0] = max(
+            heights[0], sum(l['height'] for l in first) - heights[1])
+        place(sum(heights))
+        x = frames[frame[0]]
+        top = self.y
+        cell(head[0], head_style, x, top, widths[0], heights[0] + heights[1])
+        cell(head[1], head_style, x + offsets[1], top, widths[1] + widths[2], heights[0])
+        top -= heights[0]
+        cell(head[2], head_style, x + offsets[1], top, widths[1], heights[1])
+        cell(head[3], head_style, x + offsets[2], top, widths[2], heights[1])
+        top -= heights[1]
+        for i in range(3):
+            cell(head[4 + i], head_style, x + offsets[i], top, widths[i], heights[2])
+        self.y = top - heights[2]
+        self.overflowed = False
+
+        size = text_style['size']
+        face = self.face(False)
+        baseline_offset = (row_height - (face.ascent - face.descent) * size) / 2 + face.ascent * size
+        data = block['rows']
+        for start in range(0, len(data), CHUNK_ROWS):
+            chunk = data[start:start + CHUNK_ROWS]
+            if hasattr(chunk, 'tolist'):
+                chunk = chunk.tolist()
+            for row in chunk:
+                place(row_height)
+                x = frames[frame[0]]
+                bottom = self.y - row_height
+                ops = [
+                    f'{x:.2f} {bottom:.2f} {widths[0]:.2f} {row_height:.2f} re '
+                    f'{x + offsets[1]:.2f} {bottom:.2f} {widths[1]:.2f} {row_height:.2f} re '
+                    f'{x + offsets[2]:.2f} {bottom:.2f} {widths[2]:.2f} {row_height:.2f} re S',
+                    f'BT /{face.resource} {size:g} Tf']
+                baseline = self.y - baseline_offset
+                for text, offset, width in zip(row, offsets, widths):
+                    text_x = x + offset + (width - face.width(text, size)) / 2
+                    ops.append(
+                        f'1 0 0 1 {text_x:.2f} {baseline:.2f} Tm <{face.encode(text)}> Tj')
+                ops.append('ET')
+                self.ops.append(' '.join(ops))
+                self.y = bottom
+                self.overflowed = False
+        self.pending = 'page'
+
+    # Fonts and document structure
+
+    def write_face(self, face):
+        font = face.font
+        writer = self.writer
+        font_id, cid_id, descriptor_id, file_id, unicode_id = [
+            writer.reserve() for i in range(5)]
+        name = re.sub('[^A-Za-z0-9-]', '', splitext(basename(font.name))[0])
+        name = f'EXWSUB+{name or "Serif"}'
+        scale = 1000 / font.units_per_em
+
+        data = font.subset(face.used)
+        writer.write_stream(file_id, data, f' /Length1 {len(data)}')
+        bbox = ' '.join(str(round(v * scale)) for v in font.bbox)
+        writer.write_object(
+            descriptor_id,
+            f'<< /Type /FontDescriptor /FontName /{name} /Flags 34 '
+            f'/FontBBox [{bbox}] /ItalicAngle 0 '
+            f'/Ascent {round(font.ascent * scale)} '
+            f'/Descent {round(font.descent * scale)} '
+            f'/CapHeight {round(font.cap_height * scale)} /StemV 80 '
+            f'/FontFile2 {file_id} 0 R >>')
+        widths = ' '.join(
+            f'{gid} [{round(font.advances[gid] * scale)}]'
+            for gid in sorted(face.used))
+        writer.write_object(
+            cid_id,
+            f'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{name} '
+            '/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) '
+            '/Supplement 0 >> '
+            f'/FontDescriptor {descriptor_id} 0 R /CIDToGIDMap /Identity '
+            f'/W [{widths}] >>')
+
+        entries = sorted(face.used.items())
+        chunks = []
+        for i in range(0, len(entries), 100):
+            part = entries[i:i + 100]
+            chunks.append(f'{len(part)} beginbfchar')
+            chunks += [
+                f'<{gid:04X}> <{ch.encode("utf-16-be").hex().upper()}>'
+                for gid, ch in part]
+            chunks.append('endbfchar')
+        cmap = '\n'.join([
+            '/CIDInit /ProcSet findresource begin',
+            '12 dict begin',
+            'begincmap',
+            '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) '
+            '/Supplement 0 >> def',
+            '/CMapName /Adobe-Identity-UCS def',
+            '/CMapType 2 def',
+            '1 begincodespacerange',
+            '<0000> <FFFF>',
+            'endcodespacerange',
+            *chunks,
+            'endcmap',
+            'CMapName currentdict /CMap defineresource pop',
+            'end',
+            'end'])
+        writer.write_stream(unicode_id, cmap.encode('latin-1'))
+        writer.write_object(
+            font_id,
+            f'<< /Type /Font /Subtype /Type0 /BaseFont /{name} '
+            f'/Encoding /Identity-H /DescendantFonts [{cid_id} 0 R] '
+            f'/ToUnicode {unicode_id} 0 R >>')
+        return font_id
+
+    def finish(self):
+        self.finish_page()
+        writer = self.writer
+        fonts = ' '.join(
+            f'/{face.resource} {self.write_face(face)} 0 R'
+            for face in self.faces if face.used)
+        writer.write_object(
+            self.resources_id, f'<< /Font << {fonts} >> >>')
+        kids = ' '.join(f'{p} 0 R' for p in self.page_ids)
+        writer.write_object(
+            self.pages_id,
+            f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>')
+        root_id = writer.reserve()
+        writer.write_object(
+            root_id, f'<< /Type /Catalog /Pages {self.pages_id} 0 R >>')
+        info_id = writer.reserve()
+        writer.write_object(info_id, '<< /Producer (ex_to_word) >>')
+        writer.finish(root_id, info_id)
+
+
+@timeit('save_pdf')
+def write_pdf(model, target, compress_level=DEFAULT_COMPRESS_LEVEL):
+    write_output(target, lambda f: _write_pdf(model, f, compress_level))
+
+def _write_pdf(model, f, compress_level):
+    document = _PdfDocument(_Writer(f, compress_level))
+    for block in model['blocks']:
+        kind = block['type']
+        if kind == 'section':
+            document.pending = 'part'
+        elif kind == 'page_break':
+            document.pending = document.pending or 'page'
+        elif kind == 'paragraph':
+            document.paragraph(block)
+        elif kind == 'signature':
+            document.signature(block)
+        elif kind == 'table':
+            document.table(block)
+    document.finish()
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from atomic import write_atomically
+from instrumentation import timeit
+
+DOCUMENT_FORMATS = ['docx', 'pdf', 'odt']
+
+
+def write_output(target, write):
+    # A path is written through a temporary file next to it and renamed
+    # into place, so no reader ever sees half a document. Binary streams,
+    # like an in-memory buffer for an uploader, are written directly.
+    if not isinstance(target, str):
+        write(target)
+        return
+    try:
+        write_atomically(write, target, 'wb')
+    except PermissionError:
+        print(f'<{target}> is busy - permission denied.')
+        raise
+
+def _compression(save_options):
+    # Only the docx writer splits its work across threads.
+    if save_options and 'compress_level' in save_options:
+        return {'compress_level': save_options['compress_level']}
+    return {}
+
+def render_docx(model, _path, stream_rows=None, save_options=None):
+    from directive import Directive
+
+    directive = Directive(stream_rows)
+    directive._save(directive._render(model), _path, **(save_options or {}))
+
+@timeit('render_pdf')
+def render_pdf(model, _path, stream_rows=None, save_options=None):
+    from pdf_backend import write_pdf
+
+    write_pdf(model, _path, **_compression(save_options))
+
+@timeit('render_odt')
+def render_odt(model, _path, stream_rows=None, save_options=None):
+    from odt_backend import write_odt
+
+    write_odt(model, _path, **_compression(save_options))
+
+BACKENDS = {'docx': render_docx, 'pdf': render_pdf, 'odt': render_odt}
+
+def render_documents(model, base_path, formats=('docx',), stream_rows=None,
+        save_options=None):
+    # Backends only read the model, so several formats render side by side.
+    jobs = [(BACKENDS[f], f'{base_path}.{f}') for f in formats]
+    if not jobs:
+        return
+    if len(jobs) == 1:
+        render, _path = jobs[0]
+        render(model, _path, stream_rows, save_options)
+        return
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [
+            executor.submit(render, model, _path, stream_rows, save_options)
+            for render, _path in jobs]
+        for future in futures:
+            future.result()
+
+def render_to_buffer(model, document_format='docx', stream_rows=None,
+        save_options=None):
+    buffer = BytesIO()
+    BACKENDS[document_format](model, buffer, stream_rows, save_options)
+    return buffer.getvalue()
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from hashlib import sha256
+from os import stat
+from shutil import copyfileobj
+from threading import Lock
+
+from atomic import link_atomically, write_atomically
+
+REUSE_MODES = ['link', 'copy', 'off']
+DEFAULT_MAX_CATALOGS = 32
+
+
+def content_digest(_path):
+    h = sha256()
+    with open(_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_or_copy(source, _path, mode='link'):
+    if mode == 'link':
+        try:
+            link_atomically(source, _path)
+            return
+        except OSError:
+            pass
+    with open(source, 'rb') as f:
+        write_atomically(lambda target: copyfileobj(f, target), _path, 'wb')
+
+
+class CatalogMemo:
+
+    # Catalogs seen earlier in the batch, keyed by the digest of the xlsx
+    # file and by the fingerprint of the parsed values, so that identical
+    # catalogs are parsed, formatted and exported once per process.
+
+    def __init__(self, mode='link', max_catalogs=DEFAULT_MAX_CATALOGS):
+        self.mode = mode
+        self.max_catalogs = max_catalogs
+        self._catalogs = OrderedDict()
+        self._formatted = OrderedDict()
+        self._exports = {}
+        self._lock = Lock()
+
+    def _get(self, entries, key):
+        with self._lock:
+            value = entries.get(key)
+            if value is not None:
+                entries.move_to_end(key)
+            return value
+
+    def _put(self, entries, key, value):
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.max_catalogs:
+                entries.popitem(last=False)
+
+    def catalog(self, digest):
+        return self._get(self._catalogs, digest)
+
+    def add_catalog(self, digest, title, coordinates):
+        self._put(self._catalogs, digest, (title, coordinates))
+
+    def format(self, coordinates):
+        key = coordinates.fingerprint()
+        formatted = self._get(self._formatted, key)
+        if formatted is None:
+            formatted = coordinates.format()
+            self._put(self._formatted, key, formatted)
+        return formatted
+
+    def _stamp(self, _path):
+        try:
+            s = stat(_path)
+        except OSError:
+            return None
+        return s.st_ino, s.st_mtime_ns, s.st_size
+
+    def _forget(self, _path):
+        # _path is about to hold other values, so it stops being a source.
+        for key in [k for k, v in self._exports.items() if v[0] == _path]:
+            del self._exports[key]
+
+    def export(self, coordinates, ext, _path, write):
+        # An export of the same values written earlier is linked or copied
+        # instead of being written again, as long as the file is still the
+        # one that was written.
+        key = (coordinates.fingerprint(), ext)
+        with self._lock:
+            source = self._exports.get(key)
+        if (source is not None and source[0] != _path and
+                self._stamp(source[0]) == source[1:]):
+            with self._lock:
+                self._forget(_path)
+            try:
+                link_or_copy(source[0], _path, self.mode)
+                return
+            except OSError:
+                pass
+        with self._lock:
+            self._forget(_path)
+        if not write():
+            return
+        stamp = self._stamp(_path)
+        if stamp is not None:
+            with self._lock:
+                self._exports[key] = (_path, *stamp)
@@ -0,0 +1,102 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import scandir, stat
+from os.path import abspath, join, sep
+
+INDEX_VERSION = 2
+
+
+def _scan_one(directory, cached):
+    try:
+        mtime = stat(directory).st_mtime_ns
+    except OSError:
+        return None
+    if cached is not None and cached['mtime'] == mtime:
+        return cached
+
+    subdirs = []
+    files = []
+    try:
+        with scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    subdirs.sort()
+    files.sort()
+    return {'mtime': mtime, 'subdirs': subdirs, 'files': files}
+
+def walk_tree(target_dir, threads=8, cache=None):
+    # Directories are scanned level by level, every level is spread over
+    # the thread pool. A directory whose mtime has not changed is taken
+    # from the cache without being listed again.
+    cache = cache or {}
+    result = {}
+    frontier = [abspath(target_dir)]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        while frontier:
+            records = executor.map(
+                lambda d: _scan_one(d, cache.get(d)), frontier)
+            next_frontier = []
+            for directory, record in zip(frontier, records):
+                if record is None:
+                    continue
+                result[directory] = record
+                next_frontier += [join(directory, d) for d in record['subdirs']]
+            frontier = next_frontier
+    return result
+
+def find_candidates(tree, filenames):
+    result = {}
+    for directory in sorted(tree):
+        files = tree[directory]['files']
+        found = [f for f in filenames if f in files]
+        if found:
+            result[directory] = {
+                'files': found,
+                'missing': [f for f in filenames if f not in files]
+            }
+    return result
+
+def load_index(index_file):
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index['tree']
+
+def save_index(index_file, tree):
+    index = {
+        'version': INDEX_VERSION,
+        'tree': tree
+    }
+    try:
+        with open(index_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+    except IOError:
+        print(f'I/O error with <{index_file}>.')
+
+def _is_below(directory, root):
+    return directory == root or directory.startswith(root.rstrip(sep) + sep)
+
+def build_index(target_dir, filenames, threads=8, index_file=None):
+    # The index holds the trees of every target it has seen, keyed by
+    # absolute path, so several targets can share one index file.
+    cache = (load_index(index_file) if index_file else None) or {}
+    tree = walk_tree(target_dir, threads, cache)
+    if index_file:
+        root = abspath(target_dir)
+        index = {d: r for d, r in cache.items() if not _is_below(d, root)}
+        index.update(tree)
+        save_index(index_file, index)
+    return tree, find_candidates(tree, filenames)
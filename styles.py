@@ -0,0 +1,72 @@
+# Page geometry and paragraph styles of the directive in points. They
+# mirror what Directive sets up in python-docx, for the backends that lay
+# the document out themselves.
+CM = 72 / 2.54
+
+PAGE = {
+    'width': 21 * CM,
+    'height': 29.7 * CM,
+    'left': 3 * CM,
+    'right': 1.5 * CM,
+    'top': 2 * CM,
+    'bottom': 2 * CM,
+    'header': 1.27 * CM,
+    'header_size': 12,
+    'column_gap': 1.27 * CM,
+}
+FONT_NAME = 'Times New Roman'
+# Run flags of the template masks: a filled substitution and one that
+# was left empty.
+HIGHLIGHTS = {1: 'ffff00', 2: 'ff0000'}
+# Share of the column width taken by point IDs, X and Y.
+TABLE_COLUMNS = [0.4, 0.3, 0.3]
+
+
+def _style(base, **changes):
+    return dict(base, **changes)
+
+_TEXT = {
+    'size': 14,
+    'bold': False,
+    'align': 'justify',
+    'first_indent': 1.25 * CM,
+    'left_indent': 0,
+    'line_spacing': 1.15,
+    'space_before': 0,
+    'space_after': 0,
+}
+
+STYLES = {}
+STYLES['Directive Text'] = _style(_TEXT)
+STYLES['Directive Title'] = _style(
+    STYLES['Directive Text'], bold=True, align='center', first_indent=0,
+    space_before=238, space_after=42)
+STYLES['Directive Position'] = _style(
+    STYLES['Directive Text'], align='left', first_indent=0)
+STYLES['Directive Name'] = _style(STYLES['Directive Text'], align='right')
+STYLES['Appendix Text'] = _style(_TEXT, space_after=14)
+STYLES['Appendix Document Number'] = _style(
+    STYLES['Appendix Text'], size=13, align='left', first_indent=0,
+    left_indent=11 * CM)
+STYLES['Appendix Title'] = _style(
+    STYLES['Appendix Document Number'], space_after=0)
+STYLES['Appendix Document Title'] = _style(
+    STYLES['Appendix Text'], bold=True, align='center', first_indent=0)
+STYLES['Table Text'] = _style(
+    _TEXT, size=11, align='center', first_indent=0, line_spacing=1.0)
+STYLES['Table Heading'] = _style(STYLES['Table Text'], bold=True)
+
+
+def table_head(coordinates_title):
+    index = coordinates_title.find(')', None)
+    if index:
+        coordinates_title = coordinates_title[:index+1]
+    return [
+        'Обозначение характерных точек границ',
+        coordinates_title,
+        'X',
+        'Y',
+        '(1)',
+        '(2)',
+        '(3)'
+    ]
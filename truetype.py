@@ -0,0 +1,209 @@
+import struct
+
+# Tables a PDF viewer needs from an embedded TrueType font, see PDF 1.7,
+# 9.9 "Embedded Font Programs". Layout and naming tables are left out.
+_SUBSET_TABLES = [
+    b'OS/2', b'cvt ', b'fpgm', b'glyf', b'head', b'hhea', b'hmtx', b'loca',
+    b'maxp', b'prep']
+
+# Flags of composite glyph components.
+_ARG_1_AND_2_ARE_WORDS = 0x0001
+_WE_HAVE_A_SCALE = 0x0008
+_MORE_COMPONENTS = 0x0020
+_WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+_WE_HAVE_A_TWO_BY_TWO = 0x0080
+
+
+def _checksum(data):
+    data += b'\0' * (-len(data) % 4)
+    return sum(struct.unpack(f'>{len(data) // 4}I', data)) & 0xFFFFFFFF
+
+
+class TrueTypeFont:
+
+    def __init__(self, _path):
+        with open(_path, 'rb') as f:
+            self.data = f.read()
+        self.name = _path
+        version, num_tables = struct.unpack('>IH', self.data[:6])
+        if version not in (0x00010000, 0x74727565):
+            raise ValueError(f'<{_path}> is not a TrueType font.')
+        self.tables = {}
+        for i in range(num_tables):
+            tag, checksum, offset, length = struct.unpack(
+                '>4sIII', self.data[12 + 16*i:28 + 16*i])
+            self.tables[tag] = (offset, length)
+
+        head = self.table(b'head')
+        self.units_per_em, = struct.unpack('>H', head[18:20])
+        self.bbox = struct.unpack('>4h', head[36:44])
+        self.long_loca, = struct.unpack('>h', head[50:52])
+        hhea = self.table(b'hhea')
+        self.ascent, self.descent, self.line_gap = struct.unpack(
+            '>3h', hhea[4:10])
+        number_of_metrics, = struct.unpack('>H', hhea[34:36])
+        self.num_glyphs, = struct.unpack('>H', self.table(b'maxp')[4:6])
+        hmtx = self.table(b'hmtx')
+        metrics = struct.unpack(
+            f'>{2 * number_of_metrics}H', hmtx[:4 * number_of_metrics])
+        self.advances = list(metrics[::2])
+        self.advances += [self.advances[-1]] * (self.num_glyphs - number_of_metrics)
+        self.cap_height = self.ascent
+        if b'OS/2' in self.tables:
+            os2 = self.table(b'OS/2')
+            if struct.unpack('>H', os2[:2])[0] >= 2 and len(os2) >= 90:
+                self.cap_height, = struct.unpack('>h', os2[88:90])
+        self.cmap = self._read_cmap()
+
+    def table(self, tag):
+        offset, length = self.tables[tag]
+        return self.data[offset:offset + length]
+
+    def _read_cmap(self):
+        cmap = self.table(b'cmap')
+        num_subtables, = struct.unpack('>H', cmap[2:4])
+        subtables = {}
+        for i in range(num_subtables):
+            platform, encoding, offset = struct.unpack(
+                '>HHI', cmap[4 + 8*i:12 + 8*i])
+            subtables[(platform, encoding)] = offset
+        for key in [(3, 10), (0, 4), (3, 1), (0, 3)]:
+            if key not in subtables:
+                continue
+            offset = subtables[key]
+            subtable_format, = struct.unpack('>H', cmap[offset:offset + 2])
+            if subtable_format == 4:
+                return self._read_cmap_4(cmap, offset)
+            if subtable_format == 12:
+                return self._read_cmap_12(cmap, offset)
+        raise ValueError(f'<{self.name}> has no Unicode character map.')
+
+    def _read_cmap_4(self, cmap, offset):
+        seg_count = struct.unpack('>H', cmap[offset + 6:offset + 8])[0] // 2
+        start = offset + 14
+        end_codes = struct.unpack(f'>{seg_count}H', cmap[start:start + 2*seg_count])
+        start += 2*seg_count + 2
+        start_codes = struct.unpack(f'>{seg_count}H', cmap[start:start + 2*seg_count])
+        start += 2*seg_count
+        deltas = struct.unpack(f'>{seg_count}h', cmap[start:start + 2*seg_count])
+        start += 2*seg_count
+        range_offsets_start = start
+        range_offsets = struct.unpack(
+            f'>{seg_count}H', cmap[start:start + 2*seg_count])
+        result = {}
+        for i in range(seg_count):
+            for code in range(start_codes[i], end_codes[i] + 1):
+                if code == 0xFFFF:
+                    continue
+                if range_offsets[i] == 0:
+                    glyph = (code + deltas[i]) & 0xFFFF
+                else:
+                    position = (
+                        range_offsets_start + 2*i + range_offsets[i] +
+                        2 * (code - start_codes[i]))
+                    glyph, = struct.unpack('>H', cmap[position:position + 2])
+                    if glyph:
+                        glyph = (glyph + deltas[i]) & 0xFFFF
+                if glyph:
+                    result[code] = glyph
+        return result
+
+    def _read_cmap_12(self, cmap, offset):
+        num_groups, = struct.unpack('>I', cmap[offset + 12:offset + 16])
+        result = {}
+        for i in range(num_groups):
+            start_code, end_code, start_glyph = struct.unpack(
+                '>3I', cmap[offset + 16 + 12*i:offset + 28 + 12*i])
+            for code in range(start_code, end_code + 1):
+                result[code] = start_glyph + code - start_code
+        return result
+
+    def _glyph_offsets(self):
+        loca = self.table(b'loca')
+        if self.long_loca:
+            return struct.unpack(f'>{self.num_glyphs + 1}I', loca[:4 * (self.num_glyphs + 1)])
+        return [
+            2 * o for o in
+            struct.unpack(f'>{self.num_glyphs + 1}H', loca[:2 * (self.num_glyphs + 1)])]
+
+    def _components(self, glyph):
+        # Glyph IDs a composite glyph is assembled from.
+        result = []
+        if len(glyph) < 10 or struct.unpack('>h', glyph[:2])[0] >= 0:
+            return result
+        position = 10
+        while True:
+            flags, component = struct.unpack('>HH', glyph[position:position + 4])
+            result.append(component)
+            position += 4
+            position += 4 if flags & _ARG_1_AND_2_ARE_WORDS else 2
+            if flags & _WE_HAVE_A_SCALE:
+                position += 2
+            elif flags & _WE_HAVE_AN_X_AND_Y_SCALE:
+                position += 4
+            elif flags & _WE_HAVE_A_TWO_BY_TWO:
+                position += 8
+            if not flags & _MORE_COMPONENTS:
+                return result
+
+    def subset(self, glyphs):
+        # Glyph IDs stay the same, unused glyphs are emptied. That keeps
+        # the font valid for an Identity CID to glyph mapping.
+        offsets = self._glyph_offsets()
+        glyf = self.table(b'glyf')
+        keep = set(glyphs) | {0}
+        pending = list(keep)
+        while pending:
+            gid = pending.pop()
+            for component in self._components(glyf[offsets[gid]:offsets[gid + 1]]):
+                if component not in keep:
+                    keep.add(component)
+                    pending.append(component)
+
+        new_glyf = []
+        new_offsets = [0]
+        size = 0
+        for gid in range(self.num_glyphs):
+            if gid in keep:
+                glyph = glyf[offsets[gid]:offsets[gid + 1]]
+                glyph += b'\0' * (-len(glyph) % 4)
+                new_glyf.append(glyph)
+                size += len(glyph)
+            new_offsets.append(size)
+
+        tables = {}
+        for tag in _SUBSET_TABLES:
+            if tag in self.tables:
+                tables[tag] = self.table(tag)
+        tables[b'glyf'] = b''.join(new_glyf)
+        tables[b'loca'] = struct.pack(f'>{len(new_offsets)}I', *new_offsets)
+        head = bytearray(tables[b'head'])
+        head[8:12] = b'\0\0\0\0'
+        head[50:52] = struct.pack('>h', 1)
+        tables[b'head'] = bytes(head)
+        return self._build(tables)
+
+    def _build(self, tables):
+        tags = sorted(tables)
+        num_tables = len(tags)
+        entry_selector = num_tables.bit_length() - 1
+        search_range = 16 * (1 << entry_selector)
+        header = struct.pack(
+            '>IHHHH', 0x00010000, num_tables, search_range, entry_selector,
+            16 * num_tables - search_range)
+        directory = []
+        body = []
+        offset = 12 + 16 * num_tables
+        for tag in tags:
+            data = tables[tag]
+            directory.append(struct.pack(
+                '>4sIII', tag, _checksum(data), offset, len(data)))
+            data += b'\0' * (-len(data) % 4)
+            body.append(data)
+            offset += len(data)
+        font = bytearray(header + b''.join(directory) + b''.join(body))
+        head_offset = 12 + 16 * num_tables + sum(
+            len(b) for t, b in zip(tags, body) if t < b'head')
+        adjustment = (0xB1B0AFBA - _checksum(bytes(font))) & 0xFFFFFFFF
+        font[head_offset + 8:head_offset + 12] = struct.pack('>I', adjustment)
+        return bytes(font)
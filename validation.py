@@ -0,0 +1,130 @@
+import threading
+
+# A segment this many times longer than the median segment of its contour
+# is reported as a likely spike or mistyped coordinate.
+SEGMENT_OUTLIER_FACTOR = 10.0
+MAX_LISTED = 5
+
+_lock = threading.Lock()
+_catalogs = []
+
+
+def _listed(values, label=None):
+    values = [(label or _label)(v) for v in values]
+    if len(values) > MAX_LISTED:
+        return ', '.join(values[:MAX_LISTED]) + f' and {len(values) - MAX_LISTED} more'
+    return ', '.join(values)
+
+def _label(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else f'{value:g}'
+
+def _point(value):
+    # A point ID as it is written in the catalog, numeric or not.
+    try:
+        return _label(value)
+    except (TypeError, ValueError):
+        return str(value).strip() or '?'
+
+def _numeric(column):
+    import numpy as np
+
+    if column.dtype == object:
+        valid = np.array(
+            [type(v) in (int, float) for v in column], dtype=bool)
+        values = np.where(valid, column, np.nan).astype(np.float64)
+    else:
+        values = column.astype(np.float64)
+    return values, np.flatnonzero(~np.isfinite(values))
+
+def validate_catalog(coordinates):
+    import numpy as np
+
+    ids, id_errors = _numeric(coordinates.ids)
+    x, x_errors = _numeric(coordinates.x)
+    y, y_errors = _numeric(coordinates.y)
+    # Findings name points by their ID, which is what a reviewer finds in
+    # the catalog, rather than by their position among the data rows.
+    points = coordinates.ids
+    findings = []
+    for name, errors in [('ID', id_errors), ('X', x_errors), ('Y', y_errors)]:
+        if len(errors):
+            findings.append(
+                f'non-numeric {name} at points {_listed(points[errors], _point)}')
+
+    valid = np.isfinite(x) & np.isfinite(y)
+    closed = bool(
+        len(x) > 2 and valid[0] and valid[-1] and
+        x[0] == x[-1] and y[0] == y[-1])
+    if len(x) and not closed:
+        findings.append('contour is not closed')
+
+    # The closing point repeats the first one and is left out of the
+    # numbering checks.
+    contour_ids = ids[:-1] if closed else ids
+    contour_ids = contour_ids[np.isfinite(contour_ids)]
+    unique, counts = np.unique(contour_ids, return_counts=True)
+    duplicates = unique[counts > 1]
+    if len(duplicates):
+        findings.append(f'duplicate point IDs {_listed(duplicates)}')
+    gaps = np.flatnonzero(np.diff(contour_ids) != 1)
+    if len(gaps):
+        jumps = [
+            f'{_label(contour_ids[i])}->{_label(contour_ids[i + 1])}'
+            for i in gaps[:MAX_LISTED]]
+        more = f' and {len(gaps) - MAX_LISTED} more' if len(gaps) > MAX_LISTED else ''
+        findings.append(f'point IDs not consecutive at {", ".join(jumps)}{more}')
+
+    rows = np.flatnonzero(valid)
+    px = x[rows]
+    py = y[rows]
+    lengths = np.hypot(np.diff(px), np.diff(py))
+    perimeter = float(lengths.sum())
+    if len(lengths):
+        median = float(np.median(lengths))
+        repeated = np.flatnonzero(lengths == 0)
+        if len(repeated):
+            findings.append(
+                'repeated points after points '
+                f'{_listed(points[rows[repeated]], _point)}')
+        if median > 0:
+            outliers = np.flatnonzero(
+                lengths > SEGMENT_OUTLIER_FACTOR * median)
+            if len(outliers):
+                findings.append(
+                    f'segments over {SEGMENT_OUTLIER_FACTOR:g}x the median '
+                    f'length after points {_listed(points[rows[outliers]], _point)}')
+
+    bbox = None
+    if len(px):
+        bbox = [
+            float(px.min()), float(py.min()),
+            float(px.max()), float(py.max())]
+    return {
+        'points': len(coordinates),
+        'closed': closed,
+        'perimeter': perimeter,
+        'bbox': bbox,
+        'findings': findings
+    }
+
+def record(directory, catalog, result):
+    with _lock:
+        _catalogs.append({'directory': directory, 'catalog': catalog, **result})
+
+def drain_catalogs():
+    global _catalogs
+    with _lock:
+        catalogs = _catalogs
+        _catalogs = []
+    return catalogs
+
+def merge_catalogs(catalogs):
+    with _lock:
+        _catalogs.extend(catalogs)
+
+def print_findings(catalogs):
+    flagged = [c for c in catalogs if c['findings']]
+    for c in flagged:
+        print(f"Check <{c['directory']}/{c['catalog']}>: {'; '.join(c['findings'])}.")
+    print(f'Validation: {len(flagged)} of {len(catalogs)} catalogs with findings.')
@@ -0,0 +1,178 @@
+import os
+import select
+import struct
+import sys
+from os.path import abspath, dirname, join
+from time import monotonic, sleep
+
+from scanner import walk_tree
+
+DEFAULT_POLL_INTERVAL = 2.0
+
+# inotify(7) event bits.
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+    _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_ONLYDIR)
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+
+    # One inotify watch per directory, directories created later are
+    # added as their events arrive. Uses libc directly, so there is no
+    # dependency beyond Linux itself.
+
+    def __init__(self, directories):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(self._get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        try:
+            for directory in directories:
+                self._add(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            errno = self._get_errno()
+            # The directory may be gone already, running out of watches
+            # (ENOSPC) is an error the caller falls back from.
+            if errno == 28:
+                raise OSError(errno, 'inotify watch limit reached')
+            return
+        self._watches[wd] = directory
+
+    def _read(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(os.read(self._fd, 1 << 16))
+            except BlockingIOError:
+                return b''.join(chunks)
+
+    def changes(self, timeout):
+        # Paths of changed entries, a directory path when a whole directory
+        # appeared or the kernel queue overflowed.
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = self._read()
+        result = []
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, position)
+            position += _EVENT.size
+            name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+            position += length
+            if mask & _IN_Q_OVERFLOW:
+                result += list(self._watches.values())
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & _IN_IGNORED:
+                del self._watches[wd]
+                continue
+            _path = join(directory, name) if name else directory
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                # Files can land in a new directory before it is watched,
+                # so the whole subtree is reported.
+                for subdirectory in walk_tree(_path, 1):
+                    self._add(subdirectory)
+                    result.append(subdirectory)
+            result.append(_path)
+        return result
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+
+    # Relists the tree every interval seconds. Listings of directories
+    # whose mtime has not changed are reused, files of interest are
+    # compared by mtime and size, as saving a file in place leaves the
+    # mtime of its directory alone.
+
+    def __init__(self, roots, filenames, extra_files=(), interval=DEFAULT_POLL_INTERVAL):
+        self.roots = [abspath(r) for r in roots]
+        self.filenames = set(filenames)
+        self.extra_files = [abspath(f) for f in extra_files]
+        self.interval = interval
+        self._tree = {}
+        self._stats = self._poll()
+        self._next_poll = monotonic() + interval
+
+    def _stat(self, _path):
+        try:
+            s = os.stat(_path)
+        except OSError:
+            return None
+        return s.st_mtime_ns, s.st_size
+
+    def _poll(self):
+        tree = {}
+        for root in self.roots:
+            tree.update(walk_tree(root, cache=self._tree))
+        self._tree = tree
+        stats = {}
+        for directory, record in tree.items():
+            for f in record['files']:
+                if f in self.filenames:
+                    _path = join(directory, f)
+                    stats[_path] = self._stat(_path)
+        for _path in self.extra_files:
+            stats[_path] = self._stat(_path)
+        return stats
+
+    def changes(self, timeout):
+        wait = max(0, self._next_poll - monotonic())
+        if timeout is not None and timeout < wait:
+            sleep(timeout)
+            return []
+        sleep(wait)
+        stats = self._poll()
+        self._next_poll = monotonic() + self.interval
+        changed = [p for p, s in stats.items() if self._stats.get(p) != s]
+        changed += [p for p in self._stats if p not in stats]
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(roots, directories, filenames, extra_files=(), poll_interval=None):
+    # inotify unless a poll interval is asked for or inotify is unavailable.
+    if poll_interval is None:
+        try:
+            watched = set(directories) | {dirname(abspath(f)) for f in extra_files}
+            return InotifyWatcher(sorted(watched))
+        except (OSError, AttributeError) as e:
+            print(f'Watching by polling, inotify is unavailable: {e}.')
+            poll_interval = DEFAULT_POLL_INTERVAL
+    return PollingWatcher(roots, filenames, extra_files, poll_interval)
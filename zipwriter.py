@@ -0,0 +1,147 @@
+import zlib
+from collections import deque
+from struct import pack
+from time import localtime
+
+STORED = 0
+DEFLATED = 8
+# zlib level of python-docx and zipfile; 0 stores members uncompressed.
+DEFAULT_COMPRESS_LEVEL = 6
+CHUNK_SIZE = 1 << 20
+SAVE_THREADS = 4
+
+_DATA_DESCRIPTOR = 0x08
+
+
+def compress(data, level, final=True):
+    # Raw deflate data as stored in a zip member. A chunk that is not final
+    # ends on a byte boundary, so chunks compressed apart can be joined.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ZipWriter:
+
+    # Writes members that were compressed beforehand, possibly in other
+    # threads, or streams them. It only ever appends, so the output can be
+    # a file, an in-memory buffer or a pipe.
+
+    def __init__(self, f, level=DEFAULT_COMPRESS_LEVEL):
+        self.f = f
+        self.level = level
+        self.method = DEFLATED if level else STORED
+        self.position = 0
+        self.members = []
+        t = localtime()
+        self.dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        self.dos_date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+
+    def _write(self, data):
+        self.f.write(data)
+        self.position += len(data)
+
+    def _local_header(self, name, flags, crc, compressed_size, size):
+        self._write(pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, flags, self.method,
+            self.dos_time, self.dos_date, crc, compressed_size, size,
+            len(name), 0) + name)
+
+    def prepare(self, data):
+        # Safe to call from any thread.
+        if self.level:
+            return compress(data, self.level), zlib.crc32(data), len(data)
+        return data, zlib.crc32(data), len(data)
+
+    def add(self, name, prepared):
+        data, crc, size = prepared
+        name = name.encode('utf-8')
+        offset = self.position
+        self._local_header(name, 0, crc, len(data), size)
+        self._write(data)
+        self.members.append((name, 0, crc, len(data), size, offset))
+
+    def open(self, name, executor=None, threads=1):
+        return _MemberStream(self, name.encode('utf-8'), executor, threads)
+
+    def close(self):
+        start = self.position
+        for name, flags, crc, compressed_size, size, offset in self.members:
+            self._write(pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, self.method,
+                self.dos_time, self.dos_date, crc, compressed_size, size,
+                len(name), 0, 0, 0, 0, 0, offset) + name)
+        self._write(pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(self.members),
+            len(self.members), self.position - start, start, 0))
+
+
+class _MemberStream:
+
+    # Sizes and checksum follow the data in a data descriptor. With an
+    # executor, CHUNK_SIZE pieces are deflated in parallel and written in
+    # order, with at most two per thread in flight. Readers such as Java's
+    # ZipInputStream only accept data descriptors on deflated entries, so
+    # a stored member is buffered and added with known sizes instead.
+
+    def __init__(self, writer, name, executor=None, threads=1):
+        self.writer = writer
+        self.name = name
+        self.executor = executor
+        self.in_flight = max(2, 2 * threads)
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.compressor = None
+        if writer.level and executor is None:
+            self.compressor = zlib.compressobj(writer.level, zlib.DEFLATED, -15)
+        if writer.level:
+            self.offset = writer.position
+            writer._local_header(name, _DATA_DESCRIPTOR, 0, 0, 0)
+
+    def _emit(self, data):
+        if data:
+            self.compressed_size += len(data)
+            self.writer._write(data)
+
+    def _submit(self, final):
+        chunk = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(
+            compress, chunk, self.writer.level, final))
+        while len(self.pending) > (0 if final else self.in_flight):
+            self._emit(self.pending.popleft().result())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if not self.writer.level:
+            self.buffer.append(data)
+        elif self.compressor is not None:
+            self._emit(self.compressor.compress(data))
+        else:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= CHUNK_SIZE:
+                self._submit(False)
+
+    def close(self):
+        if not self.writer.level:
+            self.writer.add(
+                self.name.decode('utf-8'),
+                (b''.join(self.buffer), self.crc, self.size))
+            self.buffer = []
+            return
+        if self.compressor is not None:
+            self._emit(self.compressor.flush())
+        else:
+            self._submit(True)
+        self.writer._write(pack(
+            '<IIII', 0x08074b50, self.crc, self.compressed_size, self.size))
+        self.writer.members.append((
+            self.name, _DATA_DESCRIPTOR, self.crc, self.compressed_size,
+            self.size, self.offset))